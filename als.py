@@ -2,17 +2,277 @@
 import numpy as np
 from sklearn.linear_model import LassoCV, RidgeCV, Ridge, Lasso
 from scipy.linalg import block_diag, null_space, eigh
-from bstt import Block, BlockSparseTensor, BlockSparseTT, BlockSparseTTSystem, BlockSparseTTSystem2
+from scipy.linalg.blas import dsyrk
+from scipy.sparse.linalg import LinearOperator, lsqr
+from bstt import Block, BlockSparseTensor, BlockSparseTT, BlockSparseTTSystem, BlockSparseTTSystem2, ThreadPool
 import sys
 from matplotlib import pyplot as plt
 import time
 
 
+class Workspace(object):
+    """
+    Pool of reusable buffers for the microsteps of a solver.
+
+    Every buffer is identified by a name. It is allocated with the largest size that was requested so far and
+    every request of the same or a smaller size returns a view into the existing memory. The buffers are thus sized
+    once for the largest core position and only grow when the block structure grows (i.e. after `increase_block`).
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, _name, _shape):
+        size = int(np.prod(_shape))
+        buffer = self.buffers.get(_name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size)
+            self.buffers[_name] = buffer
+        return buffer[:size].reshape(_shape)
+
+    def zeros(self, _name, _shape):
+        ret = self.get(_name, _shape)
+        ret[...] = 0
+        return ret
+
+    def clear(self):
+        self.buffers = {}
+
+
+class Budget(object):
+    """
+    Wall-clock (in seconds) and compute (in estimated floating point operations) budget of a run. `None` means unlimited.
+
+    The solvers charge the estimated cost of every microstep. A sweep is only started if the cost of the previous sweep
+    still fits into the remaining budget and a running sweep is aborted as soon as the budget is exhausted.
+    The best model after a complete sweep is kept as a snapshot and restored when the budget runs out.
+    """
+    def __init__(self, _time=None, _flops=None):
+        self.time = _time
+        self.flops = _flops
+        self.start = time.perf_counter()
+        self.spentFlops = 0
+        self.sweepStart = (self.start, 0)
+        self.sweepCost = (0, 0)
+        self.bestResidual = np.inf
+        self.best = None
+
+    @property
+    def active(self):
+        return self.time is not None or self.flops is not None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def charge(self, _flops):
+        self.spentFlops += _flops
+
+    def exhausted(self):
+        return (self.time is not None and self.elapsed() > self.time) or (self.flops is not None and self.spentFlops > self.flops)
+
+    def start_sweep(self):
+        self.sweepStart = (time.perf_counter(), self.spentFlops)
+
+    def end_sweep(self, _residual, _solver):
+        self.sweepCost = (time.perf_counter() - self.sweepStart[0], self.spentFlops - self.sweepStart[1])
+        if self.active and _residual < self.bestResidual:
+            self.bestResidual = _residual
+            self.best = _solver.snapshot()
+
+    def allows_sweep(self):
+        if self.time is not None and self.elapsed() + self.sweepCost[0] > self.time:
+            return False
+        if self.flops is not None and self.spentFlops + self.sweepCost[1] > self.flops:
+            return False
+        return True
+
+    def restore_best(self, _solver):
+        if self.best is not None and self.bestResidual < _solver.residual():
+            _solver.restore(self.best)
+
+
+def local_operator(_L, _E, _R, _blocks):
+    """
+    Matrix-free version of the local operator `Op` of shape (N, dofs) that is assembled in `ALS.microstep`.
+
+    Returns the functions `matvec(x) = Op @ x` and `rmatvec(y) = Op.T @ y`. Both are evaluated block by block
+    directly from the stacks `_L`, `_R` and the measurement `_E` and need only O(N*r) additional memory.
+    """
+    N = _L.shape[0]
+    blocks = [Block(block) for block in _blocks]
+    offsets = np.cumsum([0] + [block.size for block in blocks]).tolist()
+
+    def matvec(_x):
+        ret = np.zeros(N)
+        for e, block in enumerate(blocks):
+            X = _x[offsets[e]:offsets[e+1]].reshape(block.shape)
+            LX = (_L[:, block[0]] @ X.reshape(X.shape[0], -1)).reshape(N, *X.shape[1:])
+            ret += np.einsum('ner,ne,nr -> n', LX, _E[:, block[1]], _R[:, block[2]])
+        return ret
+
+    def rmatvec(_y):
+        ret = np.empty(offsets[-1])
+        for e, block in enumerate(blocks):
+            ER = np.einsum('ne,nr -> ner', _E[:, block[1]], _R[:, block[2]]).reshape(N, -1)
+            ret[offsets[e]:offsets[e+1]] = ((_y[:, None]*_L[:, block[0]]).T @ ER).reshape(-1)
+        return ret
+
+    return matvec, rmatvec
+
+
+def assemble_operator(_L, _E, _R, _blocks, _out=None):
+    """
+    Assemble the local operator of shape (N, dofs) whose columns are the block-wise Khatri-Rao products of `_L`, `_E` and `_R`.
+
+    Blocks that share the same left and mode slice reuse the partial product of `_L` and `_E`.
+    Every block is written directly into its column range of `_out` which is allocated if it is not given.
+    """
+    N = _L.shape[0]
+    blocks = [Block(block) for block in _blocks]
+    offsets = np.cumsum([0] + [block.size for block in blocks]).tolist()
+    if _out is None:
+        _out = np.empty((N, offsets[-1]))
+    assert _out.shape == (N, offsets[-1])
+    groups = {}
+    for e, block in enumerate(blocks):
+        groups.setdefault((block[0].start, block[0].stop, block[1].start, block[1].stop), []).append(e)
+    for group in groups.values():
+        LE = np.einsum('nl,ne -> nle', _L[:, blocks[group[0]][0]], _E[:, blocks[group[0]][1]])
+        for e in group:
+            out = _out[:, offsets[e]:offsets[e+1]].reshape(N, *blocks[e].shape)  # splits only the contiguous last axis, hence a view
+            np.multiply(LE[:, :, :, None], _R[:, None, None, blocks[e][2]], out=out)
+    return _out
+
+
+def leverage_sketch(_L, _E, _R, _blocks, _size):
+    """
+    Sample `_size` rows of the local operator of `_L`, `_E`, `_R` and `_blocks` (with replacement) for a sketched least squares problem.
+
+    The rows are drawn with probabilities proportional to the sum over the blocks of the products of the leverage scores of the rows
+    of the restricted factors _L[:, block[0]], _E[:, block[1]] and _R[:, block[2]], mixed half and half with the uniform distribution.
+    This is a product-of-marginals heuristic: the leverage scores of the row-wise Khatri-Rao products in the local operator are not
+    the products of the marginal ones, so the sketch has no guarantee. The scores only need QR decompositions of (N, r) matrices,
+    so the operator is never formed. Returns the sampled indices and the weights 1/sqrt(_size*p) of the sampled rows.
+    """
+    N = _L.shape[0]
+    marginals = {}
+
+    def leverage(_mode, _factor, _slice):
+        key = (_mode, _slice.start, _slice.stop)
+        if key not in marginals:
+            Q = np.linalg.qr(_factor[:, _slice])[0]
+            marginals[key] = np.einsum('nr,nr -> n', Q, Q)
+        return marginals[key]
+    scores = np.zeros(N)
+    for block in _blocks:
+        scores += leverage(0, _L, block[0]) * leverage(1, _E, block[1]) * leverage(2, _R, block[2])
+    p = 0.5*scores/np.sum(scores) + 0.5/N
+    idcs = np.random.choice(N, _size, p=p)
+    return idcs, 1/np.sqrt(_size*p[idcs])
+
+
+def assemble_two_site_operator(_L, _E1, _E2, _R, _blocks, _out=None):
+    """
+    Two-site analogue of `assemble_operator` for the merged core of two neighbouring components with blocks of order 4.
+    """
+    N = _L.shape[0]
+    blocks = [Block(block) for block in _blocks]
+    offsets = np.cumsum([0] + [block.size for block in blocks]).tolist()
+    if _out is None:
+        _out = np.empty((N, offsets[-1]))
+    assert _out.shape == (N, offsets[-1])
+    for e, block in enumerate(blocks):
+        LEE = np.einsum('nl,ne,nf -> nlef', _L[:, block[0]], _E1[:, block[1]], _E2[:, block[2]])
+        out = _out[:, offsets[e]:offsets[e+1]].reshape(N, *block.shape)
+        np.multiply(LEE[..., None], _R[:, None, None, None, block[3]], out=out)
+    return _out
+
+
+def align_gauge(_components, _blocks, _reference):
+    """
+    Aligns the gauge of a tensor train with right-orthogonal components 1,...,order-1 to the one of `_reference`.
+
+    Every bond is transformed by a block-diagonal orthogonal matrix (one orthogonal Procrustes problem per slice of the bond),
+    from the right to the left. This retains the represented tensor, the block structure and the orthogonality.
+    Returns the list of aligned components.
+    """
+    ret = list(_components)
+    transform = np.ones((1, 1))
+    for k in reversed(range(1, len(ret))):
+        comp = np.einsum('ler,rs -> les', ret[k], transform)
+        transform = np.zeros((comp.shape[0], comp.shape[0]))
+        for start, stop in sorted({(block[0].start, block[0].stop) for block in _blocks[k]}):
+            u, _, vt = np.linalg.svd(comp[start:stop].reshape(stop-start, -1) @ _reference[k][start:stop].reshape(stop-start, -1).T)
+            transform[start:stop, start:stop] = u @ vt
+        ret[k] = np.einsum('lk,ler -> ker', transform, comp)
+    ret[0] = np.einsum('ler,rs -> les', ret[0], transform)
+    return ret
+
+
+def spectral_norm(_matvec, _rmatvec, _dim, _iterations=10, _x0=None):
+    """
+    Estimate the largest singular value of the operator given by `_matvec` and `_rmatvec` by power iteration.
+    The iteration starts from `_x0` or from a random vector if it is not given.
+    """
+    x = np.random.randn(_dim) if _x0 is None else np.array(_x0, dtype=float)
+    s = 0
+    for _ in range(_iterations):
+        x /= np.linalg.norm(x)
+        x = _rmatvec(_matvec(x))
+        s = np.sqrt(np.linalg.norm(x))
+    return s
+
+
+def conjugate_gradient(_apply, _rhs, _x0, _tolerance, _maxIterations):
+    """
+    Solve the symmetric positive semi-definite system `_apply(x) = _rhs` starting from `_x0`.
+    Terminates when the residual is smaller than `_tolerance*norm(_rhs)`.
+    """
+    x = np.array(_x0, dtype=float)
+    r = _rhs - _apply(x)
+    p = r.copy()
+    rr = r @ r
+    threshold = (_tolerance*np.linalg.norm(_rhs))**2
+    for _ in range(_maxIterations):
+        if rr <= threshold:
+            break
+        Ap = _apply(p)
+        pAp = p @ Ap
+        if pAp <= 0:
+            break
+        a = rr / pAp
+        x += a*p
+        r -= a*Ap
+        rr, rr_old = r @ r, rr
+        p = r + (rr/rr_old)*p
+    return x
+
+
+def iterative_solve(_matvec, _rmatvec, _rhs, _x0, _alpha, _method, _tolerance, _maxIterations=None):
+    """
+    Solve the (regularized) least squares problem `min |Op x - _rhs|^2 + _alpha |x|^2` matrix-free.
+
+    `_method` is either 'cg' (conjugate gradients on the normal equations) or 'lsqr'.
+    Both methods are warm started from `_x0`.
+    """
+    dim = len(_x0)
+    if _maxIterations is None:
+        _maxIterations = dim
+    if _method == 'cg':
+        return conjugate_gradient(lambda x: _rmatvec(_matvec(x)) + _alpha*x, _rmatvec(_rhs), _x0, _tolerance, _maxIterations)
+    elif _method == 'lsqr':
+        Op = LinearOperator((len(_rhs), dim), matvec=_matvec, rmatvec=_rmatvec, dtype=float)
+        return lsqr(Op, _rhs, damp=np.sqrt(_alpha), atol=_tolerance, btol=_tolerance, iter_lim=_maxIterations, x0=_x0)[0]
+    else:
+        raise ValueError(f"Unknown local solver. Expected 'cg' or 'lsqr' but got '{_method}'")
+
+
 class ALS(object):
     """
     This is the standard scalar ALS on block sparse tensor trains. As methods there are l1 and l2. l2 is the standard least square solver.
     l1 is the regularized Lasso solver (see Philipp Trunsckes papers).
     By selecting increase rank and setting _maxGroupSize one gets rank adaptvity in the sense of shadow ranks as introduced by Sebastian Kraemer.
+    The options of the local solves, the budgets, the skipping of cores, the two-site sweeps, sketching and Anderson acceleration
+    are attributes that are set after construction (see __init__).
     """
     def __init__(self, _bstt, _measurements, _values, _localL2Gramians=None, _localH1Gramians=None, _maxGroupSize=3, _verbosity=0):
         assert isinstance(_bstt, BlockSparseTT)
@@ -35,6 +295,28 @@ class ALS(object):
         self.sminFactor = 0.01
         self.maxGroupSize = _maxGroupSize
         self.method = 'l1'
+        self.localSolver = 'dense'  # 'dense', or 'cg'/'lsqr' for matrix-free l2 solves warm started from the current core
+        self.localTolerance = 1e-2  # relative to the residual of the last sweep
+        self.localMaxIterations = None
+        self.prev_residual = 1.0
+        self.workspace = Workspace()
+        self.stackCheckpoint = 1  # keep only every k-th measurement stack entry and recompute the others when the sweep passes them
+        self.timeBudget = None  # seconds, see Budget
+        self.flopBudget = None  # estimated floating point operations, see Budget
+        self.twoSite = False  # optimize merged neighbouring cores and split them by truncated SVDs (adapts the ranks instead of increaseRanks)
+        self.sketchFactor = 0  # c > 0: the dense l2 microstep solves a leverage_sketch of c times the number of dofs rows
+        self.andersonDepth = 0  # m > 0: Anderson extrapolation from the last m+1 sweeps, accepted only if it decreases the residual.
+                                # Off by default: on the polynomial regression problems the gain was negligible.
+        self.andersonHistory = []
+        self.andersonReference = None
+        self.skipTolerance = 0  # > 0: cores whose updates and residual reductions per sweep stay below this are skipped
+        self.skipPatience = 3  # number of consecutive sweeps with small updates before a core is skipped
+        self.revisitPeriod = 5  # sweeps until a skipped core is solved again
+        self.coreUpdates = [0]*self.bstt.order
+        self.coreReductions = [0]*self.bstt.order
+        self.smallSweeps = [0]*self.bstt.order
+        self.lastVisits = [-1]*self.bstt.order
+        self.lastResidual = None  # residual after the last microstep (None if unknown)
 
         if (not _localH1Gramians):
             self.localH1Gramians = [np.eye(d) for d in self.bstt.dimensions]
@@ -64,6 +346,12 @@ class ALS(object):
                     lG, lG.T, rtol=1e-14, atol=1e-14)
             self.localL2Gramians = _localL2Gramians
 
+        self.rebuild_stacks()
+
+    def rebuild_stacks(self):
+        """
+        Moves the core to position 0 and computes all stacks from scratch.
+        """
         self.leftStack = [np.ones((len(self.values), 1))] + \
             [None]*(self.bstt.order-1)
         self.rightStack = [np.ones((len(self.values), 1))]
@@ -74,9 +362,81 @@ class ALS(object):
             np.ones([1, 1])] + [None]*(self.bstt.order-1)
         self.rightL2GramianStack = [np.ones([1, 1])]
 
+        self.stacksComputed = False
         self.bstt.assume_corePosition(self.bstt.order-1)
         while self.bstt.corePosition > 0:
             self.move_core('left')
+        self.stacksComputed = True
+
+    def contract_stack(self, _direction, _stack, _position, _measurements=None):
+        if _measurements is None:
+            _measurements = self.measurements
+        if _direction == 'left':
+            return np.einsum('nl, ne, ler -> nr', _stack, _measurements[_position], self.bstt.components[_position])
+        elif _direction == 'right':
+            return np.einsum('ler, ne, nr -> nl', self.bstt.components[_position], _measurements[_position], _stack)
+        else:
+            raise ValueError(
+                f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
+
+    def stack(self, _direction, _index=-1):
+        """
+        Returns the entry _index of the left or right stack. Entries dropped by the checkpointing are recomputed from the closest stored entry below.
+        """
+        if _direction == 'left':
+            stack = self.leftStack
+            position = lambda i: i
+        else:
+            stack = self.rightStack
+            position = lambda i: self.bstt.order-1-i
+        index = _index % len(stack)
+        if stack[index] is None:
+            start = max(i for i in range(index) if stack[i] is not None)
+            entry = stack[start]
+            for i in range(start, index):
+                entry = self.contract_stack(_direction, entry, position(i))
+            stack[index] = entry
+        return stack[index]
+
+    def append_samples(self, _measurements, _values):
+        """
+        Appends the samples `_measurements` and `_values` to the solver.
+
+        The stored entries of the left and right stacks are extended by the rows of the new samples, which are contracted with the
+        current components. Subsequent sweeps continue from the current model. Skipped cores are solved again in the next sweep.
+        """
+        assert isinstance(_measurements, np.ndarray) and isinstance(_values, np.ndarray)
+        assert len(_measurements) == self.bstt.order
+        assert all(compMeas.shape == (len(_values), dim) for compMeas, dim in zip(_measurements, self.bstt.dimensions))
+        for direction, stack in [('left', self.leftStack), ('right', self.rightStack)]:
+            entry = np.ones((len(_values), 1))
+            for i in range(len(stack)):
+                if i > 0:
+                    position = i-1 if direction == 'left' else self.bstt.order-i
+                    entry = self.contract_stack(direction, entry, position, _measurements)
+                if stack[i] is not None:
+                    stack[i] = np.concatenate([stack[i], entry])
+        self.measurements = np.concatenate([self.measurements, _measurements], axis=1)
+        self.values = np.concatenate([self.values, _values])
+        self.smallSweeps = [0]*self.bstt.order
+        self.andersonHistory = []
+
+    def set_values(self, _values):
+        """
+        Replaces the values of the samples. The stacks only depend on the model and the measurements and are kept.
+        """
+        assert isinstance(_values, np.ndarray) and _values.shape == self.values.shape
+        self.values = _values
+        self.smallSweeps = [0]*self.bstt.order
+        self.andersonHistory = []
+
+    def thin_stacks(self):
+        if self.stackCheckpoint <= 1:
+            return
+        for stack in [self.leftStack, self.rightStack]:
+            for i in range(1, len(stack)-1):
+                if i % self.stackCheckpoint != 0:
+                    stack[i] = None
 
     def move_core(self, _direction):
         assert len(self.leftStack) + len(self.rightStack) == self.bstt.order+1
@@ -84,8 +444,7 @@ class ALS(object):
             len(self.rightH1GramianStack) == self.bstt.order+1
         assert len(self.leftL2GramianStack) + \
             len(self.rightL2GramianStack) == self.bstt.order+1
-        valid_stacks = all(
-            entry is not None for entry in self.leftStack + self.rightStack)
+        valid_stacks = self.stacksComputed
         if self.verbosity >= 2 and valid_stacks:
             pre_res = self.residual()
         singValues = self.bstt.move_core(_direction)
@@ -93,8 +452,9 @@ class ALS(object):
             self.leftStack.pop()
             self.leftH1GramianStack.pop()
             self.leftL2GramianStack.pop()
-            self.rightStack.append(np.einsum(
-                'ler, ne, nr -> nl', self.bstt.components[self.bstt.corePosition+1], self.measurements[self.bstt.corePosition+1], self.rightStack[-1]))
+            self.rightStack.append(self.contract_stack(
+                'right', self.stack('right'), self.bstt.corePosition+1))
+            self.thin_stacks()
             self.rightH1GramianStack.append(np.einsum(
                 'ijk, lmn, jm,kn -> il', self.bstt.components[self.bstt.corePosition+1],  self.bstt.components[self.bstt.corePosition+1], self.localH1Gramians[self.bstt.corePosition+1], self.rightH1GramianStack[-1]))
             self.rightL2GramianStack.append(np.einsum(
@@ -116,6 +476,7 @@ class ALS(object):
                         u = self.calculate_update(slc, 'left')
                         self.bstt.increase_block(i, u, np.zeros(
                             self.bstt.components[self.bstt.corePosition].shape[1:3]), 'left')
+                        self.smallSweeps[self.bstt.corePosition-1] = self.smallSweeps[self.bstt.corePosition] = 0
                         assert np.allclose(np.einsum('ijk,ijl->kl', self.bstt.components[self.bstt.corePosition-1], self.bstt.components[self.bstt.corePosition-1]), np.eye(
                             self.bstt.components[self.bstt.corePosition-1].shape[2]), rtol=1e-12, atol=1e-12)
                         if self.verbosity >= 2:
@@ -125,8 +486,9 @@ class ALS(object):
             self.rightStack.pop()
             self.rightH1GramianStack.pop()
             self.rightL2GramianStack.pop()
-            self.leftStack.append(np.einsum(
-                'nl, ne, ler -> nr', self.leftStack[-1], self.measurements[self.bstt.corePosition-1], self.bstt.components[self.bstt.corePosition-1]))
+            self.leftStack.append(self.contract_stack(
+                'left', self.stack('left'), self.bstt.corePosition-1))
+            self.thin_stacks()
             self.leftH1GramianStack.append(np.einsum(
                 'ijk, lmn, jm,il -> kn', self.bstt.components[self.bstt.corePosition-1],  self.bstt.components[self.bstt.corePosition-1], self.localH1Gramians[self.bstt.corePosition-1], self.leftH1GramianStack[-1]))
             self.leftL2GramianStack.append(np.einsum(
@@ -142,44 +504,54 @@ class ALS(object):
             raise ValueError(
                 f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
 
-    def residual(self):
+    def predict(self):
+        """
+        Returns the values of the current model at the samples, contracted from the stacks at the core position.
+        """
         core = self.bstt.components[self.bstt.corePosition]
-        L = self.leftStack[-1]
+        L = self.stack('left')
         E = self.measurements[self.bstt.corePosition]
-        R = self.rightStack[-1]
-        pred = np.einsum('ler,nl,ne,nr -> n', core, L, E, R)
-        return np.linalg.norm(pred - self.values) / np.linalg.norm(self.values)
+        R = self.stack('right')
+        return np.einsum('ler,nl,ne,nr -> n', core, L, E, R)
+
+    def residual(self):
+        return np.linalg.norm(self.predict() - self.values) / np.linalg.norm(self.values)
 
     def calculate_update(self, slc, _direction):
+        """
+        Computes the new column for the slice `slc` of the component left of the core. It is supported on the admissible rows
+        of the slice, orthogonal to the existing columns and has minimal energy w.r.t. the H1 Gramian.
+        """
         if _direction == 'left':
-            Gramian = np.einsum(
-                'ij,kl->ikjl', self.leftH1GramianStack[-1], self.localH1Gramians[self.bstt.corePosition-1])
-            n = Gramian.shape[0]*Gramian.shape[1]
-            basis = np.eye(n)
-            basis = basis.reshape(Gramian.shape)
-            blocks = self.bstt.getAllBlocksOfSlice(
-                self.bstt.corePosition-1, slc, 2)
-            for block in blocks:
-                basis[block[0], block[1], block[0], block[1]] = 0
-            basis = basis.reshape(n, n)
-            left = self.bstt.components[self.bstt.corePosition -
-                                        1][:, :, slc].reshape(n, -1)
-            basis = np.concatenate([basis, left], axis=1)
-            ns = null_space(basis.T)
-            assert ns.size > 0
-            ns = np.round(ns.reshape(*Gramian.shape[0:2], -1), decimals=14)
-            projGramian = np.einsum('ijkl,ijm,kln->mn', Gramian, ns, ns)
-            pGe, pGP = np.linalg.eigh(projGramian)
-            return np.einsum('ijk,k->ij', ns, pGP[0])
+            pos = self.bstt.corePosition-1
+            comp = self.bstt.components[pos]
+            shape = comp.shape[:2]
+            indices = np.arange(shape[0]*shape[1]).reshape(shape)
+            blocks = self.bstt.getAllBlocksOfSlice(pos, slc, 2)
+            rows = np.unique(np.concatenate([indices[block[:2]].reshape(-1) for block in blocks]))
+            # orthogonal complement of the existing columns within the admissible rows
+            existing = comp.reshape(-1, comp.shape[2])[rows, slc]
+            Q, _ = np.linalg.qr(existing, mode='complete')
+            complement = Q[:, existing.shape[1]:]
+            assert complement.size > 0
+            # Gramian = kron(leftH1GramianStack[-1], localH1Gramians[pos]) restricted to the admissible rows
+            l, e = np.divmod(rows, shape[1])
+            Gramian = self.leftH1GramianStack[-1][np.ix_(l, l)]*self.localH1Gramians[pos][np.ix_(e, e)]
+            projGramian = complement.T @ Gramian @ complement
+            _, pGP = eigh(projGramian, subset_by_index=[0, 0])
+            update = np.zeros(shape[0]*shape[1])
+            update[rows] = complement @ pGP[:, 0]
+            return update.reshape(shape)
 
     def microstep(self):
         if self.verbosity >= 2:
             pre_res = self.residual()
+        self.lastResidual = None  # set by the solvers that obtain the residual of the solution
 
         core = self.bstt.components[self.bstt.corePosition]
-        L = self.leftStack[-1]
+        L = self.stack('left')
         E = self.measurements[self.bstt.corePosition]
-        R = self.rightStack[-1]
+        R = self.stack('right')
         coreBlocks = self.bstt.blocks[self.bstt.corePosition]
         N = len(self.values)
         
@@ -193,61 +565,274 @@ class ALS(object):
             RGL2 = self.rightL2GramianStack[-1]
             assert np.allclose(LGL2, np.eye(LGL2.shape[0]), rtol=1e-12, atol=1e-12)
     
-            Op_blocks = []
-            Weights = []
-            Tr_blocks = []
-            for block in coreBlocks:
-                op = np.einsum('nl,ne,nr -> nler',
-                               L[:, block[0]], E[:, block[1]], R[:, block[2]])
-                Op_blocks.append(op.reshape(N, -1))
-    
-                # update stacks after diagonalization of left and right gramian
-                Le, LP = np.linalg.eigh(LGH1[block[0], block[0]])
-                Ee, EP = np.linalg.eigh(EGH1[block[1], block[1]])
-                Re, RP = np.linalg.eigh(RGH1[block[2], block[2]])
-                #assert np.allclose(LP.T@LGH1[block[0],block[0]]@LP, np.diag(Le), rtol=1e-12, atol=1e-12)
-                #assert np.allclose(RP.T@RGH1[block[2],block[2]]@RP, np.diag(Re), rtol=1e-12, atol=1e-12),RP.T@RGH1[block[2],block[2]]@RP
-    
-                RPL2 = RP.T@RGL2[block[2], block[2]]@RP
-                Re = Re/np.diag(RPL2)
-    
-                tr = np.einsum('il,jm,kn->ijklmn', LP, EP, RP)
-                Tr_blocks.append(tr.reshape(
-                    Op_blocks[-1].shape[1], Op_blocks[-1].shape[1]))
-    
-                Weights.extend(np.einsum('i,j,k->ijk', Le, Ee, Re).reshape(-1))
-            Op = np.concatenate(Op_blocks, axis=1)
-            Transform = block_diag(*Tr_blocks)
-            assert np.allclose(Transform@Transform.T,
-                               np.eye(Transform.shape[0]), rtol=1e-14, atol=1e-14)
-    
-            Weights = np.sqrt(Weights)
-            inverseWeightMatrix = np.diag(np.reciprocal(Weights))
-    
-            OpTr = Op@Transform@inverseWeightMatrix
-            reg = LassoCV(eps=1e-7, cv=10, random_state=0,
-                          fit_intercept=False).fit(OpTr, self.values)
-            Res = reg.coef_
-    
-            core[...] = BlockSparseTensor(
-                Transform@inverseWeightMatrix@Res, coreBlocks, core.shape).toarray()
+            dofs = sum(Block(block).size for block in coreBlocks)
+            Op = assemble_operator(L, E, R, coreBlocks, self.workspace.get('Op', (N, dofs)))
+            Res = self.lasso(Op, coreBlocks, [LGH1, EGH1, RGH1], RGL2)
+            BlockSparseTensor(Res, coreBlocks, core.shape).toarray(core)
+        elif self.method == 'l2' and self.localSolver != 'dense':
+            x0 = BlockSparseTensor.fromarray(core, coreBlocks).data
+            matvec, rmatvec = local_operator(L, E, R, coreBlocks)
+            tolerance = max(self.localTolerance*self.prev_residual, np.finfo(float).eps)
+            Res = iterative_solve(matvec, rmatvec, self.values, x0, 0, self.localSolver, tolerance, self.localMaxIterations)
+            BlockSparseTensor(Res, coreBlocks, core.shape).toarray(core)
         elif self.method == 'l2':
-            Op_blocks = []
-            for block in coreBlocks:
-                op = np.einsum('nl,ne,nr -> nler', L[:, block[0]], E[:, block[1]], R[:, block[2]])
-                Op_blocks.append(op.reshape(N,-1))
-            Op = np.concatenate(Op_blocks, axis=1)
-            # Res = np.linalg.solve(Op.T @ Op, Op.T @ self.values)
-            Res, *_ = np.linalg.lstsq(Op, self.values, rcond=None)  # When Op.T@Op is singular (less samples then dofs in this component) then lstsq returns the minimal norm solution.
-            core[...] = BlockSparseTensor(Res, coreBlocks, core.shape).toarray()
+            dofs = sum(Block(block).size for block in coreBlocks)
+            sketchSize = int(np.ceil(self.sketchFactor*dofs))
+            Res = None
+            if 0 < sketchSize < N:
+                idcs, weights = leverage_sketch(L, E, R, coreBlocks, sketchSize)
+                Op = assemble_operator(L[idcs], E[idcs], R[idcs], coreBlocks, self.workspace.get('Op', (sketchSize, dofs)))
+                Op *= weights[:, None]
+                Res, _, rank, _ = np.linalg.lstsq(Op, weights*self.values[idcs], rcond=None)
+                if rank < dofs:  # the sketch lost directions, solve the exact problem instead
+                    Res = None
+            if Res is None:
+                Op = assemble_operator(L, E, R, coreBlocks, self.workspace.get('Op', (N, dofs)))
+                # Res = np.linalg.solve(Op.T @ Op, Op.T @ self.values)
+                Res, squaredResidual, *_ = np.linalg.lstsq(Op, self.values, rcond=None)  # When Op.T@Op is singular (less samples then dofs in this component) then lstsq returns the minimal norm solution.
+                if squaredResidual.size > 0:  # only returned for full rank
+                    self.lastResidual = np.sqrt(squaredResidual[0]) / np.linalg.norm(self.values)
+            BlockSparseTensor(Res, coreBlocks, core.shape).toarray(core)
         else:
             assert False, "No valid method chosen, methods are l1 or l2"
         if self.verbosity >= 2:
             print(
                 f"microstep.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
 
+    def lasso(self, _Op, _blocks, _H1Gramians, _rightL2Gramian):
+        """
+        Solves the l1 regularized problem for the operator `_Op` of the `_blocks` in the eigenbases of the H1 Gramians of the modes
+        (the last one relative to the right L2 Gramian), weighted by the square roots of the eigenvalues. Returns the block data.
+        """
+        Weights = []
+        Tr_blocks = []
+        for block in _blocks:
+            # update stacks after diagonalization of left and right gramian
+            eigenvalues, tr = [], np.ones((1, 1))
+            for G, slc in zip(_H1Gramians, block):
+                e, P = np.linalg.eigh(G[slc, slc])
+                eigenvalues.append(e)
+                tr = np.kron(tr, P)
+            RPL2 = P.T@_rightL2Gramian[block[-1], block[-1]]@P
+            eigenvalues[-1] = eigenvalues[-1]/np.diag(RPL2)
+            Tr_blocks.append(tr)
+
+            weights = np.ones(1)
+            for e in eigenvalues:
+                weights = np.multiply.outer(weights, e).reshape(-1)
+            Weights.extend(weights)
+        Transform = block_diag(*Tr_blocks)
+        assert np.allclose(Transform@Transform.T,
+                           np.eye(Transform.shape[0]), rtol=1e-14, atol=1e-14)
+
+        Weights = np.sqrt(Weights)
+        inverseWeightMatrix = np.diag(np.reciprocal(Weights))
+
+        OpTr = np.matmul(_Op, Transform@inverseWeightMatrix, out=self.workspace.get('OpTr', _Op.shape))
+        reg = LassoCV(eps=1e-7, cv=10, random_state=0,
+                      fit_intercept=False).fit(OpTr, self.values)
+        return Transform@inverseWeightMatrix@reg.coef_
+
+    def two_site_blocks(self, _position):
+        """
+        Returns the blocks of the merged core of the components at `_position` and `_position+1`.
+        """
+        return [Block((b1[0], b1[1], b2[1], b2[2])) for b1 in self.bstt.blocks[_position] for b2 in self.bstt.blocks[_position+1] if b1[2] == b2[0]]
+
+    def two_site_microstep(self, _direction):
+        """
+        Optimizes the merged core of the components at the core position and its neighbour in `_direction`, splits it and moves the core in `_direction`.
+        """
+        if _direction == 'right':
+            pos = self.bstt.corePosition
+            L = self.stack('left')
+            R = self.stack('right', -2)
+            LGH1, RGH1, RGL2 = self.leftH1GramianStack[-1], self.rightH1GramianStack[-2], self.rightL2GramianStack[-2]
+        elif _direction == 'left':
+            pos = self.bstt.corePosition-1
+            L = self.stack('left', -2)
+            R = self.stack('right')
+            LGH1, RGH1, RGL2 = self.leftH1GramianStack[-2], self.rightH1GramianStack[-1], self.rightL2GramianStack[-1]
+        else:
+            raise ValueError(
+                f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
+        if self.verbosity >= 2:
+            pre_res = self.residual()
+
+        blocks1, blocks2 = self.bstt.blocks[pos], self.bstt.blocks[pos+1]
+        shape = self.bstt.components[pos].shape[:2] + self.bstt.components[pos+1].shape[1:]
+        superBlocks = self.two_site_blocks(pos)
+        N = len(self.values)
+        dofs = sum(block.size for block in superBlocks)
+        Op = assemble_two_site_operator(L, self.measurements[pos], self.measurements[pos+1], R, superBlocks, self.workspace.get('Op', (N, dofs)))
+        if self.method == 'l1':
+            Res = self.lasso(Op, superBlocks, [LGH1, self.localH1Gramians[pos], self.localH1Gramians[pos+1], RGH1], RGL2)
+        elif self.method == 'l2':
+            Res, *_ = np.linalg.lstsq(Op, self.values, rcond=None)
+        else:
+            assert False, "No valid method chosen, methods are l1 or l2"
+        superCore = BlockSparseTensor(Res, superBlocks, shape).toarray().reshape(shape[0]*shape[1], shape[2]*shape[3])
+
+        # split the merged core for every slice of the bond separately
+        rowIndices = np.arange(shape[0]*shape[1]).reshape(shape[:2])
+        colIndices = np.arange(shape[2]*shape[3]).reshape(shape[2:])
+        slices = sorted({(block[2].start, block[2].stop) for block in blocks1})
+        factors = []
+        for slc in slices:
+            rows = np.concatenate([rowIndices[b1[:2]].reshape(-1) for b1 in blocks1 if (b1[2].start, b1[2].stop) == slc])
+            cols = np.concatenate([colIndices[b2[1:]].reshape(-1) for b2 in blocks2 if (b2[0].start, b2[0].stop) == slc])
+            u, sv, vt = np.linalg.svd(superCore[np.ix_(rows, cols)], full_matrices=False)
+            factors.append((rows, cols, u, sv, vt))
+        threshold = self.smin*np.linalg.norm(superCore)
+        sizes = []
+        for i, (rows, cols, u, sv, vt) in enumerate(factors):
+            size = max(np.count_nonzero(sv > threshold), 1)
+            sizes.append(min(size, self.bstt.MaxSize(i, pos, self.maxGroupSize)))
+        left = np.zeros((shape[0]*shape[1], sum(sizes)))
+        right = np.zeros((sum(sizes), shape[2]*shape[3]))
+        offset = 0
+        for size, (rows, cols, u, sv, vt) in zip(sizes, factors):
+            if _direction == 'right':
+                left[rows, offset:offset+size] = u[:, :size]
+                right[offset:offset+size, cols] = sv[:size, None]*vt[:size]
+            else:
+                left[rows, offset:offset+size] = u[:, :size]*sv[:size]
+                right[offset:offset+size, cols] = vt[:size]
+            offset += size
+        self.bstt.resize_bond(pos, sizes, left.reshape(shape[0], shape[1], -1), right.reshape(-1, shape[2], shape[3]))
+
+        # move_core drops the outdated stack entry of the replaced neighbour (the ranks are adapted by the split and not by increaseRanks)
+        increaseRanks, self.increaseRanks = self.increaseRanks, False
+        self.stacksComputed = False  # the outdated stack entry gives no residual before the move
+        self.move_core(_direction)
+        self.increaseRanks = increaseRanks
+        self.stacksComputed = True
+        if self.verbosity >= 2:
+            print(f"two-site microstep {pos}, {pos+1}.  (residual: {pre_res:.2e} --> {self.residual():.2e}, ranks: {sizes})")
+
+    def gauge_fixed_parameters(self):
+        """
+        Returns the block data of all components in the gauge of andersonReference (the core has to be at position 0).
+        If the block structure has changed the reference and the history are reset and None is returned.
+        """
+        assert self.bstt.corePosition == 0
+        if self.andersonReference is None or self.andersonReference[1] != self.bstt.blocks:
+            self.andersonReference = ([np.array(comp) for comp in self.bstt.components], [list(blocks) for blocks in self.bstt.blocks])
+            self.andersonHistory = []
+            return None
+        components = align_gauge(self.bstt.components, self.bstt.blocks, self.andersonReference[0])
+        return np.concatenate([BlockSparseTensor.fromarray(comp, blocks).data for comp, blocks in zip(components, self.bstt.blocks)])
+
+    def anderson_step(self, _input, _residual):
+        """
+        Extrapolates from the last sweep (started at the gauge fixed parameters `_input`) and the previous ones.
+        Returns the residual of the resulting model.
+        The residual of the extrapolation is computed by evaluating it, the stacks are only rebuilt when it is accepted.
+        """
+        output = self.gauge_fixed_parameters()
+        if _input is None or output is None:
+            return _residual
+        self.andersonHistory = self.andersonHistory[-self.andersonDepth:] + [(_input, output)]
+        if len(self.andersonHistory) < 2:
+            return _residual
+        X = np.array([x for x, g in self.andersonHistory])
+        G = np.array([g for x, g in self.andersonHistory])
+        dF = np.diff(G - X, axis=0)
+        gamma = np.linalg.lstsq(dF.T, G[-1] - X[-1], rcond=None)[0]
+        mixed = G[-1] - np.diff(G, axis=0).T @ gamma
+
+        components = []
+        offset = 0
+        for k, blocks in enumerate(self.bstt.blocks):
+            size = sum(Block(block).size for block in blocks)
+            components.append(BlockSparseTensor(mixed[offset:offset+size], blocks, self.bstt.components[k].shape).toarray())
+            offset += size
+        candidate = BlockSparseTT(components, self.bstt.blocks)
+        residual = np.linalg.norm(candidate.evaluate(self.measurements) - self.values) / np.linalg.norm(self.values)
+        if residual < _residual:
+            if self.verbosity >= 2:
+                print(f"Anderson step accepted (residuum: {_residual:.2e} --> {residual:.2e})")
+            self.bstt.components = components  # all components changed, hence all stacks
+            self.rebuild_stacks()
+            return residual
+        if self.verbosity >= 2:
+            print(f"Anderson step rejected (residuum: {_residual:.2e} --> {residual:.2e})")
+        self.andersonHistory = []
+        return _residual
+
+    def scheduled_microstep(self, _sweep, _skip=True):
+        """
+        Performs the microstep unless the current core is skipped (see skipTolerance) and accumulates the statistics of the core in the sweep.
+        The first and the last core are always solved. They are only solved right after the sweep turned around at their neighbour,
+        where the solve changes (almost) nothing, and their statistics would mark them as converged.
+        With `_skip == False` no core is skipped.
+        """
+        pos = self.bstt.corePosition
+        if self.skipTolerance <= 0 or pos in (0, self.bstt.order-1):
+            self.microstep()
+            return
+        if _skip and self.smallSweeps[pos] >= self.skipPatience and _sweep - self.lastVisits[pos] < self.revisitPeriod:
+            if self.verbosity >= 2:
+                print(f"skip microstep at {pos}.")
+            return
+        if self.lastVisits[pos] != _sweep:
+            self.coreUpdates[pos] = self.coreReductions[pos] = 0
+            self.lastVisits[pos] = _sweep
+        previousCore = np.array(self.bstt.components[pos])
+        # move_core and skipped microsteps do not change the model, so the residual after the last solve is still valid
+        pre_res = self.residual() if self.lastResidual is None else self.lastResidual
+        self.microstep()
+        if self.lastResidual is None:
+            self.lastResidual = self.residual()
+        res = self.lastResidual
+        self.coreUpdates[pos] += np.linalg.norm(self.bstt.components[pos] - previousCore) / max(np.linalg.norm(previousCore), np.finfo(float).tiny)
+        self.coreReductions[pos] += (pre_res - res) / max(pre_res, np.finfo(float).tiny)
+
+    def update_skip_statistics(self, _sweep):
+        """
+        Counts the consecutive sweeps in which the updates of every core were small. Returns True if a core was skipped in the sweep.
+        """
+        if self.skipTolerance <= 0:
+            return False
+        skipped = False
+        for pos in range(1, self.bstt.order-1):
+            if self.lastVisits[pos] != _sweep:
+                skipped = True
+            elif self.coreUpdates[pos] < self.skipTolerance and self.coreReductions[pos] < self.skipTolerance:
+                self.smallSweeps[pos] += 1
+            else:
+                self.smallSweeps[pos] = 0
+        return skipped
+
+    def microstep_flops(self):
+        N = len(self.values)
+        dofs = sum(Block(block).size for block in self.bstt.blocks[self.bstt.corePosition])
+        sketchSize = int(np.ceil(self.sketchFactor*dofs))
+        rows = sketchSize if 0 < sketchSize < N else N
+        return rows*dofs**2 + dofs**3
+
+    def two_site_flops(self, _direction):
+        pos = self.bstt.corePosition if _direction == 'right' else self.bstt.corePosition-1
+        N = len(self.values)
+        dofs = sum(block.size for block in self.two_site_blocks(pos))
+        return N*dofs**2 + dofs**3
+
+    def snapshot(self):
+        return ([np.array(comp) for comp in self.bstt.components], [list(blocks) for blocks in self.bstt.blocks], self.bstt.corePosition,
+                list(self.leftStack), list(self.rightStack), list(self.leftH1GramianStack), list(self.rightH1GramianStack),
+                list(self.leftL2GramianStack), list(self.rightL2GramianStack))
+
+    def restore(self, _snapshot):
+        components, blocks, corePosition, *stacks = _snapshot
+        self.bstt.components = [np.array(comp) for comp in components]
+        self.bstt.blocks = [list(b) for b in blocks]
+        self.bstt.assume_corePosition(corePosition)
+        self.leftStack, self.rightStack, self.leftH1GramianStack, self.rightH1GramianStack, \
+            self.leftL2GramianStack, self.rightL2GramianStack = [list(stack) for stack in stacks]
+
     def run(self):
         prev_residual = self.residual()
+        self.prev_residual = prev_residual
         self.smin = prev_residual*self.sminFactor
         if self.verbosity >= 1:
             print(f"Initial residuum: {prev_residual:.2e}")
@@ -255,17 +840,51 @@ class ALS(object):
         if self.increaseRanks:
             increaseRanks = True
             self.increaseRanks = False
+        budget = Budget(self.timeBudget, self.flopBudget)
+        budget.end_sweep(prev_residual, self)
+        self.lastVisits = [-1]*self.bstt.order  # the sweeps are counted from 0 in every run
+        fullSweep = False
         for sweep in range(self.maxSweeps):
             if sweep >= self.initialSweeps and increaseRanks == True:
                 self.increaseRanks = True
-            while self.bstt.corePosition < self.bstt.order-1:
-                self.microstep()
+            if not budget.allows_sweep():
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+            budget.start_sweep()
+            if self.andersonDepth > 0:
+                sweepInput = self.gauge_fixed_parameters()
+            self.lastResidual = None
+            while self.bstt.corePosition < self.bstt.order-1 and not budget.exhausted():
+                if self.twoSite:
+                    budget.charge(self.two_site_flops('right'))
+                    self.two_site_microstep('right')
+                    continue
+                budget.charge(self.microstep_flops())
+                self.scheduled_microstep(sweep, not fullSweep)
                 self.move_core('right')
-            while self.bstt.corePosition > 0:
-                self.microstep()
+            while self.bstt.corePosition > 0 and not budget.exhausted():
+                if self.twoSite:
+                    budget.charge(self.two_site_flops('left'))
+                    self.two_site_microstep('left')
+                    continue
+                budget.charge(self.microstep_flops())
+                self.scheduled_microstep(sweep, not fullSweep)
                 self.move_core('left')
+            if self.bstt.corePosition > 0:  # the sweep was aborted
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
 
+            skipped = self.update_skip_statistics(sweep)
             residual = self.residual()
+            if self.andersonDepth > 0:
+                residual = self.anderson_step(sweepInput, residual)
+            budget.end_sweep(residual, self)
             if self.verbosity >= 1:
                 print(f"[{sweep}] Residuum: {residual:.2e}")
 
@@ -275,19 +894,31 @@ class ALS(object):
                     print(f"Final residuum: {self.residual():.2e}")
                 return
 
-            if residual > prev_residual:
+            # A sweep that skipped cores and stagnates is followed by a full sweep. The stopping tests of the full sweep compare
+            # with the residual before the skipped sweep.
+            confirmingSweep = fullSweep
+            if confirmingSweep:
+                prev_residual = stagnationResidual
+            fullSweep = skipped and (residual > prev_residual or (prev_residual - residual) < self.minDecrease*residual)
+            stagnationResidual = prev_residual
+
+            if residual > prev_residual and not fullSweep:
                 if self.verbosity >= 1:
                     print(f"Terminating (residual increases)")
                     print(f"Final residuum: {self.residual():.2e}")
                 return
 
-            if (prev_residual - residual) < self.minDecrease*residual:
+            if (prev_residual - residual) < self.minDecrease*residual and not fullSweep:
                 if self.verbosity >= 1:
                     print(f"Terminating (minDecrease reached)")
                     print(f"Final residuum: {self.residual():.2e}")
                 return
 
+            if confirmingSweep:  # the full sweep still decreased the residual, so the skipped cores had not converged
+                self.smallSweeps = [0]*self.bstt.order
+
             prev_residual = residual
+            self.prev_residual = prev_residual
             self.smin = prev_residual*self.sminFactor
 
         if self.verbosity >= 1:
@@ -295,12 +926,69 @@ class ALS(object):
         if self.verbosity >= 1:
             print(f"Final residuum: {self.residual():.2e}")
 
+class MultiStartALS(object):
+    """
+    Runs ALS from K initial guesses (e.g. several `BlockSparseTT.random`) for the same values and keeps the best.
+
+    Every start is a plain ALS instance in `solvers`, whose options are set after construction. All starts are run for pruneAfter
+    sweeps, then every start whose residual exceeds pruneFactor times the best residual is dropped and the remaining starts are run
+    to convergence. The solves run one after the other, so all starts share one workspace.
+    """
+    def __init__(self, _bstts, _measurements, _values, _verbosity=0):
+        assert len(_bstts) > 0
+        self.solvers = [ALS(bstt, _measurements, _values, _verbosity=max(_verbosity-1, 0)) for bstt in _bstts]
+        for solver in self.solvers[1:]:
+            solver.workspace = self.solvers[0].workspace
+        self.verbosity = _verbosity
+        self.pruneAfter = 2
+        self.pruneFactor = 2
+
+    @property
+    def bstts(self):
+        return [solver.bstt for solver in self.solvers]
+
+    @property
+    def best(self):
+        return self.solvers[np.argmin(self.residuals())].bstt
+
+    def residuals(self):
+        return np.array([solver.residual() for solver in self.solvers])
+
+    def prune(self, _residuals):
+        keep = np.flatnonzero(_residuals <= self.pruneFactor*np.min(_residuals))
+        if self.verbosity >= 1 and len(keep) < len(self.solvers):
+            print(f"Pruning {len(self.solvers)-len(keep)} of {len(self.solvers)} starts")
+        self.solvers = [self.solvers[k] for k in keep]
+
+    def run_solver(self, _solver, _maxSweeps):
+        maxSweeps, increaseRanks = _solver.maxSweeps, _solver.increaseRanks
+        _solver.maxSweeps = _maxSweeps
+        _solver.run()
+        _solver.maxSweeps, _solver.increaseRanks = maxSweeps, increaseRanks
+
+    def run(self):
+        for solver in self.solvers:
+            self.run_solver(solver, min(self.pruneAfter, solver.maxSweeps))
+        residuals = self.residuals()
+        if self.verbosity >= 1:
+            print(f"Residua after {self.pruneAfter} sweeps: " + ", ".join(f"{res:.2e}" for res in residuals))
+        self.prune(residuals)
+        for solver in self.solvers:
+            if solver.maxSweeps > self.pruneAfter:
+                self.run_solver(solver, solver.maxSweeps-self.pruneAfter)
+        if self.verbosity >= 1:
+            print(f"Final residuum: {np.min(self.residuals()):.2e} ({len(self.solvers)} starts)")
+
+
 class ALSGrad(object):
     '''
     This is an ALS which learns the scalar function from data of the gradient. _measurements are the evaluation of the basis funcitons
     as above. _measurements_grad are the evaluation of the derivatives of the basis functions.
     Note: It is important to choose a block sparse format which fixes at least one degree of freedom, e.g. the constant polynomial
     since else the problem is not unique.
+    The stacks store per-sample vectors of shape (N, r). The sums over the derivative directions left and right of the core are stored
+    as per-sample factors of shape (N, k, r) whose Gram matrices are the summed outer products. They are compressed by a QR decomposition
+    as soon as k exceeds r. The normal matrix is accumulated with symmetric rank-k updates (only the upper triangle).
     '''
     def __init__(self, _bstt, _measurements,_measurements_grad, _values, _verbosity=0):
         self.bstt = _bstt
@@ -315,76 +1003,68 @@ class ALSGrad(object):
         self.maxSweeps = 100
         self.targetResidual = 1e-8
         self.minDecrease = 1e-4
+        self.timeBudget = None
+        self.flopBudget = None
+        self.workspace = Workspace()
 
-        self.leftStack1 = [np.ones((1,len(self.values),1))] + [None]*(self.bstt.order-1)
-        self.leftStack2 = [np.ones((1,len(self.values),1))] + [None]*(self.bstt.order-1)
-        self.leftStack1rhs = [np.ones((1,len(self.values)))] + [None]*(self.bstt.order-1)
-        self.leftStack2rhs = [np.ones((1,len(self.values)))] + [None]*(self.bstt.order-1)
-        self.rightStack1 = [np.ones((1,len(self.values),1))]
-        self.rightStack2 = [np.ones((1,len(self.values),1))]
-        self.rightStack1rhs = [np.ones((1,len(self.values)))]
-        self.rightStack2rhs = [np.ones((1,len(self.values)))]
+        N = len(self.values)
+        self.leftStack = [np.ones((N,1))] + [None]*(self.bstt.order-1)
+        self.leftGradStack = [np.ones((N,1,1))] + [None]*(self.bstt.order-1)
+        self.leftGradRhsStack = [np.ones((N,1))] + [None]*(self.bstt.order-1)
+        self.rightStack = [np.ones((N,1))]
+        self.rightGradStack = [np.zeros((N,0,1))]  # the last component carries no derivative
+        self.rightGradRhsStack = [np.zeros((N,1))]
         self.bstt.assume_corePosition(self.bstt.order-1)
         while self.bstt.corePosition > 0:
             self.move_core('left')
 
     def move_core(self, _direction):
-        assert len(self.leftStack1) + len(self.rightStack1) == self.bstt.order+1
-        assert len(self.leftStack2) + len(self.rightStack2) == self.bstt.order+1
-        assert len(self.leftStack1rhs) + len(self.rightStack1rhs) == self.bstt.order+1
-        assert len(self.leftStack2rhs) + len(self.rightStack2rhs) == self.bstt.order+1
-        valid_stacks = all(entry is not None for entry in self.leftStack1 + self.rightStack1+self.leftStack2 + self.rightStack2+self.leftStack1rhs + self.rightStack1rhs+self.leftStack2rhs + self.rightStack2rhs)
+        assert len(self.leftStack) + len(self.rightStack) == self.bstt.order+1
+        assert len(self.leftGradStack) + len(self.rightGradStack) == self.bstt.order+1
+        assert len(self.leftGradRhsStack) + len(self.rightGradRhsStack) == self.bstt.order+1
+        valid_stacks = all(entry is not None for entry in self.leftStack + self.rightStack + self.leftGradStack + self.rightGradStack + self.leftGradRhsStack + self.rightGradRhsStack)
         if self.verbosity >= 2 and valid_stacks:
             pre_res = self.residual()
         self.bstt.move_core(_direction)
         if _direction == 'left':
-            self.leftStack1.pop()
-            self.leftStack2.pop()
-            self.leftStack1rhs.pop()
-            self.leftStack2rhs.pop()
-            comp_measure = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition+1], self.measurements[self.bstt.corePosition+1])
-            if self.bstt.corePosition+1 == self.bstt.order-1:
-                self.rightStack1.append(np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack1[-1]))
-                self.rightStack2.append(np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack2[-1]))
-                self.rightStack1rhs.append(np.einsum('imk, km -> im', comp_measure, self.rightStack1rhs[-1]))
-                self.rightStack2rhs.append(np.einsum('imk, km -> im', comp_measure, self.rightStack2rhs[-1]))
-            else:
-                comp_measure_grad = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition+1], self.measurements_grad[self.bstt.corePosition+1])
-                stack2 = np.einsum('imk, lmn, kmn -> iml', comp_measure_grad,comp_measure_grad, self.rightStack1[-1])
-                stack2rhs = np.einsum('imk, m,km -> im', comp_measure_grad,self.values[:,self.bstt.corePosition+1],  self.rightStack1rhs[-1])
-                if self.bstt.corePosition+1 < self.bstt.order-2:
-                    stack2 += np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack2[-1])
-                    stack2rhs += np.einsum('imk, km -> im', comp_measure, self.rightStack2rhs[-1])
-      
-                self.rightStack2.append(stack2)
-                self.rightStack1.append(np.einsum('imk, lmn, kmn -> iml', comp_measure,comp_measure, self.rightStack1[-1]))
-                
-                self.rightStack2rhs.append(stack2rhs)
-                self.rightStack1rhs.append(np.einsum('imk, km -> im', comp_measure, self.rightStack1rhs[-1]))
+            pos = self.bstt.corePosition+1
+            self.leftStack.pop()
+            self.leftGradStack.pop()
+            self.leftGradRhsStack.pop()
+            comp = self.bstt.components[pos]
+            E = self.measurements[pos]
+            R = self.rightStack[-1]
+            factor = np.einsum('ler, me, mkr -> mkl', comp, E, self.rightGradStack[-1], optimize=True)
+            rhs = np.einsum('ler, me, mr -> ml', comp, E, self.rightGradRhsStack[-1], optimize=True)
+            if pos < self.bstt.order-1:
+                grad = np.einsum('ler, me, mr -> ml', comp, self.measurements_grad[pos], R, optimize=True)
+                factor = np.concatenate([grad[:,None], factor], axis=1)
+                rhs += grad*self.values[:,pos,None]
+            self.rightStack.append(np.einsum('ler, me, mr -> ml', comp, E, R, optimize=True))
+            self.rightGradStack.append(self.compress(factor))
+            self.rightGradRhsStack.append(rhs)
             if self.verbosity >= 2:
                 if valid_stacks:
                     print(f"move_core {self.bstt.corePosition+1} --> {self.bstt.corePosition}.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
                 else:
                     print(f"move_core {self.bstt.corePosition+1} --> {self.bstt.corePosition}.")
         elif _direction == 'right':
-            self.rightStack1.pop()
-            self.rightStack2.pop()            
-            self.rightStack1rhs.pop()
-            self.rightStack2rhs.pop()
-
-            comp_measure = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition-1], self.measurements[self.bstt.corePosition-1])
-            comp_measure_grad = np.einsum('ler, me  -> lmr', self.bstt.components[self.bstt.corePosition-1], self.measurements_grad[self.bstt.corePosition-1])
-            stack2 = np.einsum('iml,imk, lmn -> kmn',  self.leftStack1[-1], comp_measure_grad, comp_measure_grad)
-            stack2rhs = np.einsum('im, m,imk -> km', self.leftStack1rhs[-1],self.values[:,self.bstt.corePosition-1], comp_measure_grad )
-            if self.bstt.corePosition-1 > 0:
-                stack2 += np.einsum('iml,imk, lmn -> kmn',   self.leftStack2[-1], comp_measure, comp_measure)
-                stack2rhs += np.einsum('im, imk -> km', self.leftStack2rhs[-1],comp_measure)
-
-            self.leftStack2.append(stack2)
-            self.leftStack1.append(np.einsum('iml,imk, lmn -> kmn',  self.leftStack1[-1],comp_measure,comp_measure))
-            
-            self.leftStack2rhs.append(stack2rhs)
-            self.leftStack1rhs.append(np.einsum('im, imk -> km', self.leftStack1rhs[-1],comp_measure ))
+            pos = self.bstt.corePosition-1
+            self.rightStack.pop()
+            self.rightGradStack.pop()
+            self.rightGradRhsStack.pop()
+            comp = self.bstt.components[pos]
+            E = self.measurements[pos]
+            L = self.leftStack[-1]
+            grad = np.einsum('ml, me, ler -> mr', L, self.measurements_grad[pos], comp, optimize=True)
+            factor = grad[:,None]
+            rhs = grad*self.values[:,pos,None]
+            if pos > 0:
+                factor = np.concatenate([factor, np.einsum('mkl, me, ler -> mkr', self.leftGradStack[-1], E, comp, optimize=True)], axis=1)
+                rhs += np.einsum('ml, me, ler -> mr', self.leftGradRhsStack[-1], E, comp, optimize=True)
+            self.leftStack.append(np.einsum('ml, me, ler -> mr', L, E, comp, optimize=True))
+            self.leftGradStack.append(self.compress(factor))
+            self.leftGradRhsStack.append(rhs)
             if self.verbosity >= 2:
                 if valid_stacks:
                     print(f"move_core {self.bstt.corePosition-1} --> {self.bstt.corePosition}.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
@@ -393,6 +1073,15 @@ class ALSGrad(object):
         else:
             raise ValueError(f"Unknown _direction. Expected 'left' or 'right' but got '{_direction}'")
 
+    def compress(self, _factor):
+        """
+        Replace the per-sample factors F of shape (k, r) with k > r by the triangular factor of their QR decomposition.
+        This leaves the Gram matrices F.T @ F unchanged and bounds k by r.
+        """
+        if _factor.shape[1] > _factor.shape[2]:
+            return np.linalg.qr(_factor, mode='r')
+        return _factor
+
     def residual(self):
         res = 0
         for pos in range(self.bstt.order-1):
@@ -407,65 +1096,90 @@ class ALSGrad(object):
             pre_res = self.residual()
 
         core = self.bstt.components[self.bstt.corePosition]
-        L1 = self.leftStack1[-1]
-        L2 = self.leftStack2[-1]
-        L1rhs = self.leftStack1rhs[-1]
-        L2rhs = self.leftStack2rhs[-1]
+        L = self.leftStack[-1]
+        LF = self.leftGradStack[-1]
+        Lrhs = self.leftGradRhsStack[-1]
         E = self.measurements[self.bstt.corePosition]
         E_grad = self.measurements_grad[self.bstt.corePosition]
- 
-
-        E_op = np.einsum('mp,mq->pmq',E,E)
-        E_grad_op = np.einsum('mp,mq->pmq',E_grad,E_grad)
-        R1 = self.rightStack1[-1]
-        R2 = self.rightStack2[-1]
-        R1rhs = self.rightStack1rhs[-1]
-        R2rhs = self.rightStack2rhs[-1]
+        R = self.rightStack[-1]
+        RF = self.rightGradStack[-1]
+        Rrhs = self.rightGradRhsStack[-1]
         coreBlocks = self.bstt.blocks[self.bstt.corePosition]
+        N = len(self.values)
+
+        offsets = np.cumsum([0] + [Block(block).size for block in coreBlocks]).tolist()
+        Op = self.workspace.zeros('Op', (offsets[-1], offsets[-1]))
+        Rhs = self.workspace.get('Rhs', (offsets[-1],))
+        A = self.workspace.get('A', (N, offsets[-1]))
+        # Op = sum of A.T @ A over all derivative directions. Each A is written into the same buffer
+        # and only the lower triangle of Op (the upper triangle of the Fortran ordered Op.T) is accumulated.
+        terms = [(LF[:,k], E, R) for k in range(LF.shape[1])] + [(L, E, RF[:,k]) for k in range(RF.shape[1])] + [(L, E_grad, R)]
+        for term in terms:
+            assemble_operator(*term, coreBlocks, _out=A)
+            dsyrk(1.0, A.T, beta=1.0, c=Op.T, overwrite_c=1)
+        upper = np.triu_indices(offsets[-1], 1)
+        Op[upper] = Op.T[upper]
+        np.matmul(A.T, self.values[:,self.bstt.corePosition], out=Rhs)  # A holds the last term
+        for e, block in enumerate(coreBlocks):
+            rhs = np.einsum('mi,mp,ml -> ipl', Lrhs[:,block[0]], E[:,block[1]], R[:,block[2]])
+            rhs += np.einsum('mi,mp,ml -> ipl', L[:,block[0]], E[:,block[1]], Rrhs[:,block[2]])
+            Rhs[offsets[e]:offsets[e+1]] += rhs.reshape(-1)
 
-        Op_blocks = []
-        Rhs_blocks = []
-        for block1 in coreBlocks:
-            Op_blocks_col = []
-            for block2 in coreBlocks:
-                op = np.einsum('imk,pmq,lmn -> iplkqn', L2[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
-                if self.bstt.corePosition < self.bstt.order-2:
-                    op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_op[block1[1],:, block2[1]], R2[block1[2],:, block2[2]])
-                op += np.einsum('imk,pmq,lmn -> iplkqn', L1[block1[0],:, block2[0]], E_grad_op[block1[1],:, block2[1]], R1[block1[2],:, block2[2]])
-                dim1 = op.shape[0]*op.shape[1]*op.shape[2]
-                dim2 = op.shape[3]*op.shape[4]*op.shape[5]
-                Op_blocks_col.append( op.reshape(dim1,dim2))
-            
-            rhs = np.einsum('im,mp,lm -> ipl', L2rhs[block1[0],:], E[:,block1[1]], R1rhs[block1[2],:])
-            if self.bstt.corePosition < self.bstt.order-2:
-                rhs += np.einsum('im,mp,lm -> ipl', L1rhs[block1[0],:], E[:,block1[1]], R2rhs[block1[2],:])
-            rhs += np.einsum('im,mp,lm,m -> ipl', L1rhs[block1[0],:], E_grad[:,block1[1]], R1rhs[block1[2],:],self.values[:,self.bstt.corePosition])
-            rhs = rhs.reshape(dim1)
-            
-            Rhs_blocks.append(rhs.reshape(dim1))
-            Op_blocks.append(np.concatenate(Op_blocks_col, axis=1))
-           
-        Op = np.concatenate(Op_blocks, axis=0)
-        Rhs = np.concatenate(Rhs_blocks, axis=0)
         Res = np.linalg.solve(Op, Rhs)
         #Res, *_ = np.linalg.lstsq(Op, self.values, rcond=None)  # When Op.T@Op is singular (less samples then dofs in this component) then lstsq returns the minimal norm solution.
-        core[...] = BlockSparseTensor(Res, coreBlocks, core.shape).toarray()
+        BlockSparseTensor(Res, coreBlocks, core.shape).toarray(core)
 
         if self.verbosity >= 2:
             print(f"microstep.  (residual: {pre_res:.2e} --> {self.residual():.2e})")
 
+    def microstep_flops(self):
+        N = len(self.values)
+        dofs = sum(Block(block).size for block in self.bstt.blocks[self.bstt.corePosition])
+        rows = N*(self.leftGradStack[-1].shape[1] + self.rightGradStack[-1].shape[1] + 1)
+        return rows*(dofs**2 + 2*self.bstt.components[self.bstt.corePosition].size) + dofs**3
+
+    def snapshot(self):
+        return ([np.array(comp) for comp in self.bstt.components], self.bstt.corePosition,
+                list(self.leftStack), list(self.rightStack), list(self.leftGradStack), list(self.rightGradStack),
+                list(self.leftGradRhsStack), list(self.rightGradRhsStack))
+
+    def restore(self, _snapshot):
+        components, corePosition, *stacks = _snapshot
+        self.bstt.components = [np.array(comp) for comp in components]
+        self.bstt.assume_corePosition(corePosition)
+        self.leftStack, self.rightStack, self.leftGradStack, self.rightGradStack, \
+            self.leftGradRhsStack, self.rightGradRhsStack = [list(stack) for stack in stacks]
+
     def run(self):
         prev_residual = self.residual()
         if self.verbosity >= 1: print(f"Initial residuum: {prev_residual:.2e}")
+        budget = Budget(self.timeBudget, self.flopBudget)
+        budget.end_sweep(prev_residual, self)
         for sweep in range(self.maxSweeps):
-            while self.bstt.corePosition < self.bstt.order-2:
+            if not budget.allows_sweep():
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+            budget.start_sweep()
+            while self.bstt.corePosition < self.bstt.order-2 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core('right')
-            while self.bstt.corePosition > 0:
+            while self.bstt.corePosition > 0 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core('left')
+            if self.bstt.corePosition > 0:  # the sweep was aborted
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
 
             residual = self.residual()
+            budget.end_sweep(residual, self)
             if self.verbosity >= 1: print(f"[{sweep}] Residuum: {residual:.2e}")
 
             if residual < self.targetResidual:
@@ -494,6 +1208,11 @@ class ALSGrad(object):
 class ALSSystem(object):
     '''
     This is an ALS which learns a system of equation with the use of a selection tensor (as in A. Goessmann et al.)
+    As in ALS the local problems can be solved matrix-free by setting localSolver to 'cg' or 'lsqr'.
+    The scale of the ridge parameter alpha is the largest singular value of the local operator. With spectralScale = 'svd' it is
+    computed exactly. With 'power' (power iteration) or 'diagonal' (square root of the trace, an upper bound) it is estimated from
+    the normal equations, which are then assembled directly per slice of the interaction mode.
+    With numberOfThreads > 1 the slices of the interaction mode are solved on a thread pool.
     '''
     def __init__(self, _bstt, _measurements, _values, _localL2Gramians=None, _localH1Gramians=None, _maxGroupSize=3, _verbosity=0):
         self.bstt = _bstt
@@ -519,6 +1238,15 @@ class ALSSystem(object):
         self.sminFactor = 0.01
         self.maxGroupSize = _maxGroupSize
         self.alpha = 0.1
+        self.localSolver = 'dense'
+        self.localTolerance = 1e-2
+        self.localMaxIterations = None
+        self.spectralScale = 'svd'
+        self.numberOfThreads = 1
+        self.threadPool = None
+        self.timeBudget = None
+        self.flopBudget = None
+        self.workspace = Workspace()
         if (not _localH1Gramians):
             self.localH1Gramians = [np.eye(d) for d in self.bstt.dimensions]
         else:
@@ -648,6 +1376,14 @@ class ALSSystem(object):
     #         pGe, pGP = np.linalg.eigh(projGramian)
     #         return np.einsum('ijk,k->ij',ns,pGP[0])
 
+    def thread_pool(self):
+        """
+        Returns the thread pool of the solver (created again when numberOfThreads has changed).
+        """
+        if self.threadPool is None or self.threadPool.numberOfThreads != self.numberOfThreads:
+            self.threadPool = ThreadPool(self.numberOfThreads)
+        return self.threadPool
+
     def microstep(self):
         if self.verbosity >= 2:
             pre_res = self.residual()
@@ -658,46 +1394,105 @@ class ALSSystem(object):
             self.bstt.corePosition, self.bstt.numberOfEquations)
         R = self.rightStack[-1]
         coreBlocks = self.bstt.blocks[self.bstt.corePosition]
+        equations = [np.flatnonzero(S[k] == 1) for k in range(self.bstt.interaction[self.bstt.corePosition])]
         # print(S)
 
-        Op_blocks = []
-        for block in coreBlocks:
-            op = np.einsum('nld,ne,sd,nrd -> ndlesr',
-                           L[:, block[0], :], E[:, block[1]], S[block[2], :], R[:, block[3], :])
-            Op_blocks.append(op)
-
-        core = np.zeros(self.bstt.components[self.bstt.corePosition].shape)
+        core = self.bstt.components[self.bstt.corePosition]
         shape = (core.shape[0], core.shape[1], core.shape[3])
         reducedBlocks = [Block((b[0], b[1], b[3])) for b in coreBlocks]
-        for k in range(self.bstt.interaction[self.bstt.corePosition]):
-            Op_blocks_eq = []
-            eqs = [True if S[k, l] == 1 else False for l in range(
-                self.bstt.numberOfEquations)]
-            for o in Op_blocks:
-                Op_blocks_eq.append(o[:, eqs, :, :, k, :].reshape(
-                    self.numberOfSamples*np.sum(eqs), -1))
-
-            Op = np.concatenate(Op_blocks_eq, axis=1)
-
-            U, s, VT = np.linalg.svd(Op, full_matrices=False)
-            #s = s[s>(s[0]*1e-16)]
-            #Op = U[:,:len(s)]@np.diag(s)@VT[:len(s),:]
-            rhs = self.values[:, eqs].reshape(-1, order='F')
-
-            #Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-            self.alpha = s[0]*1e-12*self.prev_residual
-            Res = np.linalg.solve(Op.T@Op+self.alpha *
-                                  np.eye(Op.shape[1]), Op.T@rhs)
+        offsets = np.cumsum([0] + [block.size for block in reducedBlocks]).tolist()
+        dofs = offsets[-1]
+        N = self.numberOfSamples
+        pool = self.thread_pool()
+        # The slices k are solved independently (possibly in parallel). Every worker slot uses its own workspace buffers
+        # and the random start vectors of the power iterations are drawn beforehand to keep the results deterministic.
+        if self.localSolver != 'dense' or self.spectralScale == 'power':
+            starts = [np.random.randn(dofs) for k in range(len(equations))]
+
+        if self.localSolver != 'dense':
+            def solve(k):
+                eqs = equations[k]
+                ops = [local_operator(L[:, :, d], E, R[:, :, d], reducedBlocks) for d in eqs]
+                def matvec(_x):
+                    return np.concatenate([op[0](_x) for op in ops])
+                def rmatvec(_y):
+                    return sum(op[1](_y[e*N:(e+1)*N]) for e, op in enumerate(ops))
+                x0 = BlockSparseTensor.fromarray(core[:, :, k, :], reducedBlocks).data
+                rhs = self.values[:, eqs].reshape(-1, order='F')
+                alpha = spectral_norm(matvec, rmatvec, dofs, _x0=starts[k])*1e-12*self.prev_residual
+                tolerance = max(self.localTolerance*self.prev_residual, np.finfo(float).eps)
+                return iterative_solve(matvec, rmatvec, rhs, x0, alpha, self.localSolver, tolerance, self.localMaxIterations), alpha
+
+        elif self.spectralScale != 'svd':
+            if self.spectralScale not in ['power', 'diagonal']:
+                raise ValueError(
+                    f"Unknown spectralScale. Expected 'svd', 'power' or 'diagonal' but got '{self.spectralScale}'")
+            def solve(k):
+                slot = pool.slot()
+                A = self.workspace.get(('A', slot), (N, dofs))
+                Gram = self.workspace.zeros(('Gram', slot), (dofs, dofs))
+                rhs = self.workspace.zeros(('rhs', slot), (dofs,))
+                for d in equations[k]:
+                    assemble_operator(L[:, :, d], E, R[:, :, d], reducedBlocks, _out=A)
+                    dsyrk(1.0, A.T, beta=1.0, c=Gram.T, overwrite_c=1)  # lower triangle of Gram
+                    rhs += A.T @ self.values[:, d]
+                upper = np.triu_indices(dofs, 1)
+                Gram[upper] = Gram.T[upper]
+                if self.spectralScale == 'power':
+                    scale = np.sqrt(spectral_norm(Gram.__matmul__, Gram.__matmul__, dofs, _x0=starts[k]))
+                else:
+                    scale = np.sqrt(np.trace(Gram))
+                alpha = scale*1e-12*self.prev_residual
+                Gram[np.diag_indices(dofs)] += alpha
+                return np.linalg.solve(Gram, rhs), alpha
+
+        else:
+            def solve(k):
+                eqs = equations[k]
+                # the rows of equation d are the local operator of its stacks (the selection matrix is one for the equations of slice k)
+                Op = self.workspace.get(('Op', pool.slot()), (N*len(eqs), dofs))
+                for e, d in enumerate(eqs):
+                    assemble_operator(L[:, :, d], E, R[:, :, d], reducedBlocks, _out=Op[e*N:(e+1)*N])
+
+                U, s, VT = np.linalg.svd(Op, full_matrices=False)
+                #s = s[s>(s[0]*1e-16)]
+                #Op = U[:,:len(s)]@np.diag(s)@VT[:len(s),:]
+                rhs = self.values[:, eqs].reshape(-1, order='F')
+
+                #Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
+                alpha = s[0]*1e-12*self.prev_residual
+                Res = np.linalg.solve(Op.T@Op+alpha *
+                                      np.eye(Op.shape[1]), Op.T@rhs)
+                # print(Op.shape,np.linalg.matrix_rank(Op,tol=1e-16),s[-1])
+                return Res, alpha
+
+        for k, (Res, alpha) in enumerate(pool.map(solve, range(len(equations)))):
+            self.alpha = alpha
             #core[:,:,k,:] = BlockSparseTensor(Transform@inverseWeightMatrix@Res, reducedBlocks, shape).toarray()
-            core[:, :, k, :] = BlockSparseTensor(
-                Res, reducedBlocks, shape).toarray()
-            # print(Op.shape,np.linalg.matrix_rank(Op,tol=1e-16),s[-1])
+            BlockSparseTensor(
+                Res, reducedBlocks, shape).toarray(core[:, :, k, :])
 
-        self.bstt.components[self.bstt.corePosition] = core
         if self.verbosity >= 2:
             print(
                 f"microstep.  (residual: {pre_res:.2e} --> {self.residual():.2e}, Norm: {np.linalg.norm(self.bstt.components[self.bstt.corePosition])})")
 
+    def microstep_flops(self):
+        rows = self.numberOfSamples*self.bstt.numberOfEquations
+        dofs = sum(Block((b[0], b[1], b[3])).size for b in self.bstt.blocks[self.bstt.corePosition])
+        return 2*rows*dofs**2 + 2*rows*self.bstt.components[self.bstt.corePosition].size
+
+    def snapshot(self):
+        return ([np.array(comp) for comp in self.bstt.components], [list(blocks) for blocks in self.bstt.blocks], self.bstt.corePosition,
+                list(self.leftStack), list(self.rightStack))
+
+    def restore(self, _snapshot):
+        components, blocks, corePosition, leftStack, rightStack = _snapshot
+        self.bstt.components = [np.array(comp) for comp in components]
+        self.bstt.blocks = [list(b) for b in blocks]
+        self.bstt.assume_corePosition(corePosition)
+        self.leftStack = list(leftStack)
+        self.rightStack = list(rightStack)
+
     def run(self):
         prev_residual = self.residual()
         self.smin = prev_residual*self.sminFactor
@@ -707,17 +1502,35 @@ class ALSSystem(object):
         if self.increaseRanks:
             increaseRanks = True
             self.increaseRanks = False
+        budget = Budget(self.timeBudget, self.flopBudget)
+        budget.end_sweep(prev_residual, self)
         for sweep in range(self.maxSweeps):
             #self.alpha =1e-15
             if sweep >= self.initialSweeps and increaseRanks == True:
                 self.increaseRanks = True
-            while self.bstt.corePosition < self.bstt.order-1:
+            if not budget.allows_sweep():
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+            budget.start_sweep()
+            while self.bstt.corePosition < self.bstt.order-1 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core('right')
-            while self.bstt.corePosition > 0:
+            while self.bstt.corePosition > 0 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core('left')
+            if self.bstt.corePosition > 0:  # the sweep was aborted
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
             residual = self.residual()
+            budget.end_sweep(residual, self)
             if self.verbosity >= 1:
                 print(f"[{sweep}] Residuum: {residual:.2e}, Norm: {np.linalg.norm(self.bstt.components[self.bstt.corePosition])}, alpha = {self.alpha}")
 
@@ -751,6 +1564,12 @@ class ALSSystem(object):
 class ALSSystem2(object):
     '''
     This is an ALS which learns a system of equation with the use of weight sharing.
+    Equations that select the same cores share their stack entries, i.e. every distinct contraction is computed and stored once.
+    The entries are never modified in place but replaced, hence the sharing is resolved automatically when a basis transformation
+    changes the stack of a single equation.
+    With normalEquations = True the local problems are not solved by least squares on the stacked operators of all equations.
+    Instead the normal equations are accumulated equation by equation, which needs only O(N*dofs + dofs^2) memory.
+    With numberOfThreads > 1 the local problems of the interaction cores and the orthogonalizations of the bstts are run on a thread pool.
     '''
     def __init__(self, _coeffs, _measurements, _values, _verbosity=0):
         self.coeffs = _coeffs
@@ -770,6 +1589,13 @@ class ALSSystem2(object):
         self.targetResidual = 1e-8
         self.minDecrease = 1e-3
         self.alpha = 0.1
+        self.normalEquations = False
+        self.chunkSize = 10000
+        self.numberOfThreads = 1
+        self.threadPool = None
+        self.timeBudget = None
+        self.flopBudget = None
+        self.workspace = Workspace()
 
         self.leftStack = [[np.ones((self.numberOfSamples, 1))] *
                           self.coeffs.numberOfEquations] + [None]*(self.coeffs.order-1)
@@ -786,15 +1612,19 @@ class ALSSystem2(object):
     def move_core(self):
         assert len(self.leftStack) + \
             len(self.rightStack) == self.coeffs.order+1
-        self.coeffs.move_core(self.direction)
+        self.coeffs.move_core(self.direction, self.thread_pool())
         if self.direction == 'left':
             self.leftStack.pop()
             newStack = []
+            contractions = {}
             for eq in range(self.coeffs.numberOfEquations):
-                comp = self.coeffs.bstts[self.coeffs.selectionMatrix[eq,
-                        self.coeffs.corePosition+1]].components[self.coeffs.corePosition+1]
-                newStack.append(np.einsum('ler, me, mr -> ml', comp,
-                                self.measurements[self.coeffs.corePosition+1], self.rightStack[-1][eq]))
+                selection = self.coeffs.selectionMatrix[eq, self.coeffs.corePosition+1]
+                key = (id(self.rightStack[-1][eq]), selection)
+                if key not in contractions:
+                    comp = self.coeffs.bstts[selection].components[self.coeffs.corePosition+1]
+                    contractions[key] = np.einsum('ler, me, mr -> ml', comp,
+                                                  self.measurements[self.coeffs.corePosition+1], self.rightStack[-1][eq])
+                newStack.append(contractions[key])
             self.rightStack.append(newStack)
             if self.verbosity >= 2:
                 print(
@@ -802,11 +1632,15 @@ class ALSSystem2(object):
         elif self.direction == 'right':
             self.rightStack.pop()
             newStack = []
+            contractions = {}
             for eq in range(self.coeffs.numberOfEquations):
-                comp = self.coeffs.bstts[self.coeffs.selectionMatrix[eq,
-                        self.coeffs.corePosition-1]].components[self.coeffs.corePosition-1]
-                newStack.append(np.einsum(
-                    'ml, me, ler -> mr', self.leftStack[-1][eq], self.measurements[self.coeffs.corePosition-1], comp))
+                selection = self.coeffs.selectionMatrix[eq, self.coeffs.corePosition-1]
+                key = (id(self.leftStack[-1][eq]), selection)
+                if key not in contractions:
+                    comp = self.coeffs.bstts[selection].components[self.coeffs.corePosition-1]
+                    contractions[key] = np.einsum(
+                        'ml, me, ler -> mr', self.leftStack[-1][eq], self.measurements[self.coeffs.corePosition-1], comp)
+                newStack.append(contractions[key])
             self.leftStack.append(newStack)
             if self.verbosity >= 2:
                 print(
@@ -817,89 +1651,140 @@ class ALSSystem2(object):
 
     def residual(self):
         pred = []
+        predictions = {}
         for eq in range(self.coeffs.numberOfEquations):
-            core = self.coeffs.bstts \
-                    [self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]] \
-                    .components[self.coeffs.corePosition]
+            selection = self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]
             L = self.leftStack[-1][eq]
-            E = self.measurements[self.coeffs.corePosition]
             R = self.rightStack[-1][eq]
-            pred.append(np.einsum('ler,ml,me,mr -> m', core, L, E, R))
+            key = (id(L), id(R), selection)
+            if key not in predictions:
+                core = self.coeffs.bstts[selection].components[self.coeffs.corePosition]
+                E = self.measurements[self.coeffs.corePosition]
+                predictions[key] = np.einsum('ler,ml,me,mr -> m', core, L, E, R)
+            pred.append(predictions[key])
         pred = np.column_stack(pred)
         return np.linalg.norm(pred.reshape(-1) - self.values.reshape(-1)) / np.linalg.norm(self.values.reshape(-1))
 
+    def least_squares(self, _operator, _rhs):
+        """
+        Solves the least squares problem for the operator whose rows for a slice of the samples are returned by `_operator`.
+        With normalEquations the operator is only built for chunkSize samples at a time.
+        """
+        if self.normalEquations:
+            Gram = 0
+            OpRhs = 0
+            for start in range(0, self.numberOfSamples, self.chunkSize):
+                slc = slice(start, start+self.chunkSize)
+                Op = _operator(slc)
+                Gram += Op.T@Op
+                OpRhs += Op.T@_rhs[slc]
+            Res, *_ = np.linalg.lstsq(Gram, OpRhs, rcond=None)
+        else:
+            Res, *_ = np.linalg.lstsq(_operator(slice(None)), _rhs, rcond=None)
+        return Res
+
+    def thread_pool(self):
+        """
+        Returns the thread pool of the solver (created again when numberOfThreads has changed).
+        """
+        if self.threadPool is None or self.threadPool.numberOfThreads != self.numberOfThreads:
+            self.threadPool = ThreadPool(self.numberOfThreads)
+        return self.threadPool
+
     def microstep(self):
         L = self.leftStack[-1]
         E = self.measurements[self.coeffs.corePosition]
         R = self.rightStack[-1]
         coreBlocks = self.coeffs.blocks[self.coeffs.corePosition]
 
-        # Build for each equation the corresponding local operator
+        N = self.numberOfSamples
+        dofs = sum(Block(block).size for block in coreBlocks)
+        pool = self.thread_pool()
+
+        # The basis transformations below replace stack entries. The local operators are built from the entries at the start of the microstep.
+        L0 = list(L)
+        R0 = list(R)
+
+        # Build for each equation the corresponding local operator (once for every distinct pair of stack entries)
         Op_eq = []
-        for eq in range(self.coeffs.numberOfEquations):
-            Op_blocks_eq = []
-            for block in coreBlocks:
-                op = np.einsum(
-                    'ml,me,mr -> mler', L[eq][:, block[0]], E[:, block[1]], R[eq][:, block[2]])
-                Op_blocks_eq.append(op.reshape(self.numberOfSamples, -1))
-            Op_eq.append(np.concatenate(Op_blocks_eq, axis=1))
+        if not self.normalEquations:
+            operators = {}
+            for eq in range(self.coeffs.numberOfEquations):
+                key = (id(L0[eq]), id(R0[eq]))
+                if key not in operators:
+                    operators[key] = assemble_operator(L0[eq], E, R0[eq], coreBlocks, self.workspace.get(('Op_eq', len(operators)), (N, dofs)))
+                Op_eq.append(operators[key])
+
+        def solve(_eqs):
+            eqs = np.flatnonzero(_eqs)
+            slot = pool.slot()  # every worker slot uses its own buffers
+            if not self.normalEquations:
+                Op = self.workspace.get(('Op', slot), (len(eqs)*N, dofs))
+                for e, eq in enumerate(eqs):
+                    Op[e*N:(e+1)*N] = Op_eq[eq]
+                rhs = self.values[:, eqs].reshape(-1, order='F')
+                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
+                return Res
+            # accumulate Op.T@Op and Op.T@rhs, equations with the same stack entries share one operator
+            groups = {}
+            for eq in eqs:
+                groups.setdefault((id(L0[eq]), id(R0[eq])), []).append(eq)
+            Gram = self.workspace.zeros(('Gram', slot), (dofs, dofs))
+            rhs = self.workspace.zeros(('rhs', slot), (dofs,))
+            Op = self.workspace.get(('Op', slot), (N, dofs))
+            for group in groups.values():
+                assemble_operator(L0[group[0]], E, R0[group[0]], coreBlocks, _out=Op)
+                dsyrk(float(len(group)), Op.T, beta=1.0, c=Gram.T, overwrite_c=1)  # lower triangle of Gram
+                rhs += Op.T @ self.values[:, group].sum(axis=1)
+            upper = np.triu_indices(dofs, 1)
+            Gram[upper] = Gram.T[upper]
+            Res, *_ = np.linalg.lstsq(Gram, rhs, rcond=None)
+            return Res
         
         # Optimize interaction range many cores
-        used = []
+        # Decide how every interaction core is updated. The least squares problems of the different cores only depend on
+        # the snapshot of the stacks and are solved independently (possibly in parallel). The basis transformations
+        # change stacks and neighbouring components and are applied afterwards in the order of k.
+        updates = []
         for k in range(self.coeffs.interactions):
-            core = self.coeffs.bstts[k].components[self.coeffs.corePosition]
             eqs = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition]
                    == k else False for eq in range(self.coeffs.numberOfEquations)]
             if sum(eqs) == 0: continue # skip if core is not used at the current position  
             if sum(eqs) == 1 or (self.direction == 'right' and k == self.coeffs.interactions-1 and self.coeffs.corePosition > 0) or  (self.direction == 'left' and k == 0 and self.coeffs.corePosition < self.coeffs.order-1):
-                used.append('first')              
-                Op_eq_aux = []
-                for i in range(len(eqs)):
-                    if eqs[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
+                updates.append((k, 'first', eqs, eqs))
             elif (self.direction == 'right' and k == 0) or (self.direction == 'left' and k == 0 and self.coeffs.corePosition == self.coeffs.order-1): 
-                used.append('second')            
-
                 eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition-1]
                        == k else False for eq in range(self.coeffs.numberOfEquations)]
+                updates.append((k, 'second', eqs, eqs2))
+            elif self.direction == 'left' and k == self.coeffs.interactions-1 or (self.direction == 'right' and k ==  self.coeffs.interactions-1 and self.coeffs.corePosition ==0): 
+                eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition+1]
+                       == k else False for eq in range(self.coeffs.numberOfEquations)]
+                updates.append((k, 'third', eqs, eqs2))
+
+        # solve for coefficents for multiple equations
+        solutions = pool.map(lambda update: solve(update[3]), updates)
+
+        used = []
+        for (k, case, eqs, eqs2), Res in zip(updates, solutions):
+            core = self.coeffs.bstts[k].components[self.coeffs.corePosition]
+            used.append(case)
+            BlockSparseTensor(
+                Res, coreBlocks, core.shape).toarray(core)
+            if case == 'second':
                 diff = np.array(eqs) == np.array(eqs2)
                 switched_eqs = np.where(diff == diff.min())[0]
                 blocks_switched_eq =  list(set([Block((b[0], b[0])) for b in coreBlocks]))
-
-                # solve for coefficents for multiple equations
-                Op_eq_aux = []
-                for i in range(len(eqs2)):
-                    if eqs2[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs2].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
                 
                 # find basistransformation to reuse coefficents
                 for switched_eq in switched_eqs:
                     R_new = np.einsum('ler, me, mr -> ml', core,
                                     self.measurements[self.coeffs.corePosition], R[switched_eq])
-                    Op_blocks_switched_eq = []
-                    for block in blocks_switched_eq:
-                        op = np.einsum(
-                            'ml,mr -> mlr', L[switched_eq][:, block[0]], R_new[:, block[1]])
-                        Op_blocks_switched_eq.append(op.reshape(self.numberOfSamples, -1))
-                    Op_switched_eq = np.concatenate(Op_blocks_switched_eq, axis=1)
+
+                    def operator(slc):
+                        return np.concatenate([np.einsum('ml,mr -> mlr', L[switched_eq][slc, block[0]], R_new[slc, block[1]]).reshape(-1, block.size)
+                                               for block in blocks_switched_eq], axis=1)
                     rhs_switched_eq = self.values[:, switched_eq].reshape(-1, order='F')
-                    Res_switched_eq, *_ = np.linalg.lstsq(Op_switched_eq, rhs_switched_eq, rcond=None)
+                    Res_switched_eq = self.least_squares(operator, rhs_switched_eq)
                     core_switched_eq = BlockSparseTensor(
                         Res_switched_eq,  blocks_switched_eq, (core.shape[0], core.shape[0])).toarray()
                     self.leftStack[-1][switched_eq] = np.einsum(
@@ -909,41 +1794,22 @@ class ALSSystem2(object):
                     self.coeffs.bstts[ self.coeffs.selectionMatrix[switched_eq, 
                         self.coeffs.corePosition-1]].components[self.coeffs.corePosition-1] = \
                         np.einsum('ler,rs->les',comp,core_switched_eq)
-            elif self.direction == 'left' and k == self.coeffs.interactions-1 or (self.direction == 'right' and k ==  self.coeffs.interactions-1 and self.coeffs.corePosition ==0): 
-                used.append('third')              
-                eqs2 = [True if self.coeffs.selectionMatrix[eq, self.coeffs.corePosition+1]
-                       == k else False for eq in range(self.coeffs.numberOfEquations)]
+            elif case == 'third':
                 diff = np.array(eqs) == np.array(eqs2)
                 switched_eqs = np.where(diff == diff.min())[0] 
                 blocks_switched_eq =  list(set([Block((b[2], b[2])) for b in coreBlocks]))
                 
-                # solve for coefficents for multiple equations
-                Op_eq_aux = []
-                for i in range(len(eqs2)):
-                    if eqs2[i]:
-                        Op_eq_aux.append(Op_eq[i])
-                
-                Op = np.concatenate(Op_eq_aux, axis=0)
-    
-                rhs = self.values[:, eqs2].reshape(-1, order='F')
-                Res, *_ = np.linalg.lstsq(Op, rhs, rcond=None)
-                #Res = np.linalg.solve(Op.T@Op+self.alpha*np.eye(Op.shape[1]), Op.T@rhs)
-                core[:, :, :] = BlockSparseTensor(
-                    Res, coreBlocks, core.shape).toarray()
-                
                 # find basistransformation to reuse coefficents
                 for switched_eq in switched_eqs:
  
                     L_new = np.einsum( 'ml, me, ler -> mr', L[switched_eq], 
                                       self.measurements[self.coeffs.corePosition], core)
-                    Op_blocks_switched_eq = []
-                    for block in blocks_switched_eq:
-                        op = np.einsum(
-                            'ml,mr -> mlr', L_new[:, block[0]], R[switched_eq][:, block[1]])
-                        Op_blocks_switched_eq.append(op.reshape(self.numberOfSamples, -1))
-                    Op_switched_eq = np.concatenate(Op_blocks_switched_eq, axis=1)
+
+                    def operator(slc):
+                        return np.concatenate([np.einsum('ml,mr -> mlr', L_new[slc, block[0]], R[switched_eq][slc, block[1]]).reshape(-1, block.size)
+                                               for block in blocks_switched_eq], axis=1)
                     rhs_switched_eq = self.values[:, switched_eq].reshape(-1, order='F')
-                    Res_switched_eq, *_ = np.linalg.lstsq(Op_switched_eq, rhs_switched_eq, rcond=None)
+                    Res_switched_eq = self.least_squares(operator, rhs_switched_eq)
                     core_switched_eq = BlockSparseTensor(
                         Res_switched_eq,  blocks_switched_eq, (core.shape[2], core.shape[2])).toarray()
                     self.rightStack[-1][switched_eq] = np.einsum(
@@ -959,21 +1825,61 @@ class ALSSystem2(object):
             print(
                 f"microstep.  (residual: {self.prev_residual:.2e} --> {self.residual():.2e}), Direction {self.direction}, Core {self.coeffs.corePosition}, used {used}, interaction {self.coeffs.interactions}")
 
+    def microstep_flops(self):
+        rows = self.numberOfSamples*self.coeffs.numberOfEquations
+        dofs = sum(Block(block).size for block in self.coeffs.blocks[self.coeffs.corePosition])
+        return 2*rows*dofs**2 + 2*rows*self.coeffs.bstts[0].components[self.coeffs.corePosition].size
+
+    def snapshot(self):
+        copies = {}  # copy every shared stack entry once to retain the sharing
+
+        def copy(_stack):
+            return [copies.setdefault(id(entry), np.array(entry)) for entry in _stack]
+        return ([[np.array(comp) for comp in bstt.components] for bstt in self.coeffs.bstts], self.coeffs.corePosition,
+                [copy(stack) for stack in self.leftStack], [copy(stack) for stack in self.rightStack])
+
+    def restore(self, _snapshot):
+        components, corePosition, leftStack, rightStack = _snapshot
+        for bstt, comps in zip(self.coeffs.bstts, components):
+            bstt.components = [np.array(comp) for comp in comps]
+        self.coeffs.assume_corePosition(corePosition)
+        self.leftStack = [list(stack) for stack in leftStack]
+        self.rightStack = [list(stack) for stack in rightStack]
+
     def run(self):
         self.prev_residual = self.residual()
         if self.verbosity >= 1:
             print(f"Initial residuum: {self.prev_residual:.2e}")
+        budget = Budget(self.timeBudget, self.flopBudget)
+        budget.end_sweep(self.prev_residual, self)
         for sweep in range(self.maxSweeps):
+            if not budget.allows_sweep():
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+            budget.start_sweep()
             self.direction = 'right'
-            while self.coeffs.corePosition < self.coeffs.order-1:
+            while self.coeffs.corePosition < self.coeffs.order-1 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core()
             self.direction = 'left'
-            while self.coeffs.corePosition > 0:
+            while self.coeffs.corePosition > 0 and not budget.exhausted():
+                budget.charge(self.microstep_flops())
                 self.microstep()
                 self.move_core()
+            if self.coeffs.corePosition > 0:  # the sweep was aborted
+                budget.restore_best(self)
+                if self.verbosity >= 1:
+                    print(f"Terminating (budget exhausted)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+            budget.charge(self.microstep_flops())
             self.microstep()
             residual = self.residual()
+            budget.end_sweep(residual, self)
             if self.verbosity >= 1:
                 print(f"[{sweep}] Residuum: {residual:.2e}")
 
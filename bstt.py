@@ -1,8 +1,50 @@
 from math import comb
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
 import numpy as np
 from scipy.sparse import block_diag, diags
 
 
+class ThreadPool(object):
+    """
+    Worker threads that are kept alive between the calls of `map`. Every worker has a fixed slot in 0,...,numberOfThreads-1
+    (see `slot`) that can be used as key of per-worker buffers. For numberOfThreads <= 1 the calls run in the calling thread in slot 0.
+    """
+    def __init__(self, _numberOfThreads=1):
+        self.numberOfThreads = _numberOfThreads
+        self.executor = None
+        self.local = threading.local()
+        self.slots = itertools.count()
+
+    def initialize(self):
+        self.local.slot = next(self.slots)
+
+    def slot(self):
+        return getattr(self.local, 'slot', 0)
+
+    def map(self, _function, _iterable):
+        if self.numberOfThreads <= 1:
+            return [_function(x) for x in _iterable]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.numberOfThreads, initializer=self.initialize)
+        return list(self.executor.map(_function, _iterable))
+
+
+def parallel_map(_function, _iterable, _numberOfThreads=1):
+    """
+    Returns the list of `_function` applied to the elements of `_iterable` in their order.
+    For `_numberOfThreads` > 1 the calls are dispatched onto a thread pool (NumPy and LAPACK release the GIL).
+    `_numberOfThreads` can also be a ThreadPool, whose threads are reused.
+    """
+    if isinstance(_numberOfThreads, ThreadPool):
+        return _numberOfThreads.map(_function, _iterable)
+    if _numberOfThreads > 1:
+        with ThreadPoolExecutor(_numberOfThreads) as executor:
+            return list(executor.map(_function, _iterable))
+    return [_function(x) for x in _iterable]
+
+
 class Block(tuple):
     def __init__(self, iterable):
         super(Block, self).__init__()
@@ -176,8 +218,13 @@ class BlockSparseTensor(object):
 
         return U, S, Vt
 
-    def toarray(self):
-        ret = np.zeros(self.shape)
+    def toarray(self, _out=None):
+        if _out is None:
+            ret = np.zeros(self.shape)
+        else:
+            assert _out.shape == self.shape
+            ret = _out
+            ret[...] = 0
         slices = np.cumsum([0] + [block.size for block in self.blocks]).tolist()
         for e,block in enumerate(self.blocks):
             ret[block] = self.data[slices[e]:slices[e+1]].reshape(block.shape)
@@ -243,6 +290,33 @@ class BlockSparseTT(object):
         assert ret.shape == (n,1)
         return ret[:,0]
 
+    @classmethod
+    def evaluate_batch(cls, _bstts, _measures, _chunkSize=10000):
+        """
+        Evaluate several BlockSparseTTs with the same block structure on the same samples. Returns an array of shape (len(_bstts), n).
+
+        The components of all tensors are stacked along a batch axis and contracted together. The samples are processed
+        in chunks of `_chunkSize` samples (all at once if `_chunkSize` is None) to bound the memory of the intermediate results.
+        Every contraction with a component is a single batched matrix product.
+        """
+        assert len(_bstts) > 0 and all(bstt.blocks == _bstts[0].blocks for bstt in _bstts)
+        assert all(cmp.shape == _bstts[0].components[pos].shape for bstt in _bstts for pos, cmp in enumerate(bstt.components))
+        order = _bstts[0].order
+        assert len(_measures) == order
+        n = len(_measures[0])
+        chunkSize = n if _chunkSize is None else _chunkSize
+        components = [np.stack([bstt.components[pos] for bstt in _bstts]) for pos in range(order)]
+        ret = np.empty((len(_bstts), n))
+        for start in range(0, n, chunkSize):
+            stop = min(start+chunkSize, n)
+            tmp = np.ones((len(_bstts), stop-start, 1))
+            for pos in range(order):
+                l, e, r = components[pos].shape[1:]
+                tmp = np.einsum('knl,ne -> knle', tmp, _measures[pos][start:stop]).reshape(len(_bstts), stop-start, l*e)
+                tmp = np.matmul(tmp, components[pos].reshape(len(_bstts), l*e, r))
+            ret[:, start:stop] = tmp[:, :, 0]
+        return ret
+
     @property
     def corePosition(self):
         return self.__corePosition
@@ -312,6 +386,168 @@ class BlockSparseTT(object):
     
     
     
+    def resize_bond(self, _position, _sizes, _left, _right):
+        """
+        Replace the components `_position` and `_position+1` by `_left` and `_right`, where the slices of the bond between them change their sizes.
+
+        The k-th slice of the bond (in increasing order) gets the size `_sizes[k]` and the blocks of both components are shifted accordingly.
+        Returns the new slices of the bond.
+        """
+        assert 0 <= _position < self.order-1
+        slices = sorted({(block[2].start, block[2].stop) for block in self.blocks[_position]})
+        assert len(_sizes) == len(slices) and all(size > 0 for size in _sizes)
+        offsets = np.cumsum([0] + list(_sizes)).tolist()
+        newSlices = {slc: slice(offsets[k], offsets[k+1]) for k, slc in enumerate(slices)}
+        assert _left.shape == self.components[_position].shape[:2] + (offsets[-1],)
+        assert _right.shape == (offsets[-1],) + self.components[_position+1].shape[1:]
+        self.blocks[_position] = [Block((block[0], block[1], newSlices[(block[2].start, block[2].stop)])) for block in self.blocks[_position]]
+        self.blocks[_position+1] = [Block((newSlices[(block[0].start, block[0].stop)], block[1], block[2])) for block in self.blocks[_position+1]]
+        self.components[_position] = _left
+        self.components[_position+1] = _right
+        self.verify()
+        return [newSlices[slc] for slc in slices]
+
+    def round(self, _sizes=None, _tolerance=0):
+        """
+        Truncate all bonds by block-wise SVDs while retaining the block structure.
+
+        `_sizes[k]` contains the maximal sizes of the slices (in increasing order) of the bond between the components `k` and `k+1`
+        (no bound if `_sizes` is None). In addition, the smallest singular values of every bond are discarded as long as the sum of
+        their squares is below (`_tolerance`*norm)**2/(order-1). Every slice retains at least one singular value.
+        The tensor is right-orthogonalized by block-wise QR decompositions and then truncated from the left to the right.
+        Afterwards the core is at position order-1.
+        """
+        assert _sizes is None or len(_sizes) == self.order-1
+        bonds = [[(0, 1)]] + [sorted({(block[2].start, block[2].stop) for block in self.blocks[k]}) for k in range(self.order-1)] + [[(0, 1)]]
+        pattern = [[(bonds[k].index((block[0].start, block[0].stop)), block[1], bonds[k+1].index((block[2].start, block[2].stop)))
+                    for block in self.blocks[k]] for k in range(self.order)]
+        sizes = [[stop-start for start, stop in bond] for bond in bonds]
+        components = list(self.components)
+
+        def slices(_bond):
+            offsets = np.cumsum([0] + sizes[_bond]).tolist()
+            return [slice(offsets[i], offsets[i+1]) for i in range(len(sizes[_bond]))]
+
+        def mask(_position, _mode, _index):
+            # The support of all blocks of the component `_position` that contain the `_index`-th slice in mode `_mode`.
+            ret = np.zeros(components[_position].shape, dtype=bool)
+            left, right = slices(_position), slices(_position+1)
+            for l, e, r in pattern[_position]:
+                if (l if _mode == 0 else r) == _index:
+                    ret[left[l], e, right[r]] = True
+            return ret
+
+        for k in reversed(range(1, self.order)):
+            comp, prev = components[k], components[k-1]
+            newComp, newPrev = [], []
+            for i, slc in enumerate(slices(k)):
+                cols = mask(k, 0, i)[slc.start].reshape(-1)
+                q, r = np.linalg.qr(comp[slc].reshape(slc.stop-slc.start, -1)[:, cols].T)
+                block = np.zeros((q.shape[1],) + comp.shape[1:])
+                block.reshape(q.shape[1], -1)[:, cols] = q.T
+                newComp.append(block)
+                newPrev.append(prev[..., slc] @ r.T)
+            components[k] = np.concatenate(newComp, axis=0)
+            components[k-1] = np.concatenate(newPrev, axis=2)
+            sizes[k] = [block.shape[0] for block in newComp]
+
+        threshold = _tolerance**2 * np.sum(components[0]**2) / max(self.order-1, 1)
+        for k in range(self.order-1):
+            comp, nxt = components[k], components[k+1]
+            svds = []
+            for j, slc in enumerate(slices(k+1)):
+                rows = mask(k, 2, j)[..., slc.start].reshape(-1)
+                svds.append((rows,) + tuple(np.linalg.svd(comp[..., slc].reshape(-1, slc.stop-slc.start)[rows], full_matrices=False)))
+            bondSizes = [len(s) if _sizes is None else min(_sizes[k][j], len(s)) for j, (rows, u, s, vt) in enumerate(svds)]
+            error = 0
+            for value, j in sorted((value, j) for j, (rows, u, s, vt) in enumerate(svds) for value in s[:bondSizes[j]]):
+                if error + value**2 > threshold:
+                    break
+                if bondSizes[j] > 1:
+                    error += value**2
+                    bondSizes[j] -= 1
+            newComp, newNext = [], []
+            for j, (rows, u, s, vt) in enumerate(svds):
+                size = bondSizes[j]
+                block = np.zeros(comp.shape[:2] + (size,))
+                block.reshape(-1, size)[rows] = u[:, :size]
+                newComp.append(block)
+                newNext.append(np.einsum('ij,jer -> ier', s[:size, None]*vt[:size], nxt[slices(k+1)[j]]))
+            components[k] = np.concatenate(newComp, axis=2)
+            components[k+1] = np.concatenate(newNext, axis=0)
+            sizes[k+1] = [block.shape[2] for block in newComp]
+
+        offsets = [np.cumsum([0] + size).tolist() for size in sizes]
+        self.blocks = [[Block((slice(offsets[k][l], offsets[k][l+1]), e, slice(offsets[k+1][r], offsets[k+1][r+1]))) for l, e, r in pattern[k]]
+                       for k in range(self.order)]
+        self.components = components
+        self.assume_corePosition(self.order-1)
+        self.verify()
+
+    @classmethod
+    def merge(cls, _bstts, _tolerance=None):
+        """
+        Returns a BlockSparseTT that represents the sum of the homogeneous polynomials `_bstts` (of equal order and dimensions),
+        e.g. the levels returned by `recover_ml`.
+
+        As in `random_homogenous_polynomial_sum`, the slices of every bond are grouped by their partial degree and an additional
+        degree component maps the final bond slice of degree d to the mode d. The merged model is evaluated on the measures augmented
+        by a measure of ones of shape (N, maxDegree+1). Since the slices of equal partial degree of all summands form one slice,
+        `round` can compress across the summands. If `_tolerance` is not None the result is rounded with this tolerance.
+        """
+        assert len(_bstts) > 0 and all(bstt.dimensions == _bstts[0].dimensions for bstt in _bstts)
+        order = _bstts[0].order
+
+        # degrees[j][k] maps the slices of the bond k of summand j to their partial degree
+        degrees = []
+        for bstt in _bstts:
+            bondDegrees = [{(0, 1): 0}]
+            for k in range(order):
+                bondDegrees.append({})
+                for block in bstt.blocks[k]:
+                    assert block[1].stop - block[1].start == 1, f"Block {Block(block)} of component {k} is not homogeneous"
+                    degree = bondDegrees[k][(block[0].start, block[0].stop)] + block[1].start
+                    assert bondDegrees[k+1].setdefault((block[2].start, block[2].stop), degree) == degree, f"Component {k} is not homogeneous"
+            degrees.append(bondDegrees)
+
+        # offsets[k][j, slc] is the position of the slice slc of the bond k of summand j in the merged bond k
+        # and groups[k][d] is the merged slice of partial degree d
+        offsets = [{(j, (0, 1)): 0 for j in range(len(_bstts))}]
+        groups = [{0: slice(0, 1)}]
+        for k in range(1, order+1):
+            offsets.append({})
+            groups.append({})
+            position = 0
+            for d in sorted({d for bondDegrees in degrees for d in bondDegrees[k].values()}):
+                start = position
+                for j, bondDegrees in enumerate(degrees):
+                    for slc in sorted(slc for slc, degree in bondDegrees[k].items() if degree == d):
+                        offsets[k][j, slc] = position
+                        position += slc[1] - slc[0]
+                groups[k][d] = slice(start, position)
+
+        maxDegree = max(groups[order])
+        dimensions = _bstts[0].dimensions + [maxDegree+1]
+        sizes = [max(group.stop for group in groups[k].values()) for k in range(order+1)] + [1]
+        components = [np.zeros((sizes[k], dim, sizes[k+1])) for k, dim in enumerate(dimensions)]
+        blocks = []
+        for k in range(order):
+            for j, bstt in enumerate(_bstts):
+                for block in map(Block, bstt.blocks[k]):
+                    left = offsets[k][j, (block[0].start, block[0].stop)]
+                    right = offsets[k+1][j, (block[2].start, block[2].stop)]
+                    components[k][left:left+block.shape[0], block[1], right:right+block.shape[2]] = bstt.components[k][block]
+            modes = sorted({(degrees[j][k][(block[0].start, block[0].stop)], block[1].start) for j, bstt in enumerate(_bstts) for block in bstt.blocks[k]})
+            blocks.append([Block((groups[k][l], slice(m, m+1), groups[k+1][l+m])) for l, m in modes])
+        blocks.append([Block((group, slice(d, d+1), slice(0, 1))) for d, group in groups[order].items()])
+        for d, group in groups[order].items():
+            components[order][group, d, 0] = 1
+
+        ret = cls(components, blocks)
+        if _tolerance is not None:
+            ret.round(None, _tolerance)
+        return ret
+
     def getUniqueSlices(self,mode):
         Blocks = self.blocks[self.corePosition]
         slices = []
@@ -668,12 +904,12 @@ class BlockSparseTTSystem2(object):
         return self.bstts[0].order
     
 
-    def move_core(self, _direction):
+    def move_core(self, _direction, _numberOfThreads=1):
         assert isinstance(self.corePosition, int)
         assert _direction in ['left', 'right']
         if _direction == 'left':
             assert 0 < self.corePosition
-            for bstt in self.bstts:
+            def move(bstt):
                 #bstt.move_core('left')
                 CORE = BlockSparseTensor.fromarray(bstt.components[bstt.corePosition], bstt.blocks[bstt.corePosition])
                 U, S, Vt = CORE.svd(0)
@@ -681,13 +917,14 @@ class BlockSparseTTSystem2(object):
                 nextCore = bstt.components[bstt.corePosition-1]
                 bstt.components[bstt.corePosition-1] = (nextCore.reshape(-1, nextCore.shape[2]) @ U ).reshape(nextCore.shape)
                 bstt.assume_corePosition(bstt.corePosition - 1)
+            parallel_map(move, self.bstts, _numberOfThreads)
 
             self.__corePosition -= 1
             
         else:
             assert self.corePosition < self.order-1
 
-            for bstt in self.bstts:
+            def move(bstt):
                 #bstt.move_core('right')
                 CORE = BlockSparseTensor.fromarray(bstt.components[bstt.corePosition], bstt.blocks[bstt.corePosition])
                 U, S, Vt = CORE.svd(2)                
@@ -695,6 +932,7 @@ class BlockSparseTTSystem2(object):
                 nextCore = bstt.components[bstt.corePosition+1]
                 bstt.components[bstt.corePosition+1] = (U.T @ nextCore.reshape(nextCore.shape[0], -1)).reshape(nextCore.shape)
                 bstt.assume_corePosition(bstt.corePosition + 1)
+            parallel_map(move, self.bstts, _numberOfThreads)
 
             self.__corePosition += 1
         self.verify()
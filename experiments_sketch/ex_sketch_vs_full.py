@@ -0,0 +1,48 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import copy
+import time
+import numpy as np
+
+from misc import random_homogenous_polynomial_sum, legendre_measures
+from als import ALS
+
+
+# Compares the l2 ALS with sketched local problems (sketchFactor > 0, see leverage_sketch) to the one with full local problems.
+# The sampling scores of leverage_sketch are a heuristic, so the residual of the sketched solution is checked against the full solve.
+
+order = 6
+degree = 3
+maxGroupSize = 2
+maxSweeps = 4
+trainSampleSize = 60000
+sketchFactors = [5, 10, 20]
+tolerance = 1.5  # admissible ratio of the sketched and the full residual
+
+np.random.seed(0)
+train_points = 2*np.random.rand(trainSampleSize, order)-1
+train_measures = legendre_measures(train_points, degree)
+augmented_train_measures = np.concatenate([train_measures, np.ones((1, trainSampleSize, degree+1))], axis=0)  # measures.shape == (order,N,degree+1)
+train_values = np.exp(-np.linalg.norm(train_points, axis=1)**2)
+bstt = random_homogenous_polynomial_sum([degree]*order, degree, maxGroupSize)
+
+residuals = {}
+for sketchFactor in [0] + sketchFactors:
+    np.random.seed(1)
+    solver = ALS(copy.deepcopy(bstt), augmented_train_measures, train_values)
+    solver.method = 'l2'
+    solver.maxSweeps = maxSweeps
+    solver.sketchFactor = sketchFactor
+    start = time.time()
+    solver.run()
+    residuals[sketchFactor] = solver.residual()
+    print(f"sketchFactor: {sketchFactor:2d}  residual: {residuals[sketchFactor]:.4e}  time: {time.time()-start:.2f}s")
+
+for sketchFactor in sketchFactors:
+    assert residuals[sketchFactor] <= tolerance*residuals[0], f"The sketched residual ({residuals[sketchFactor]:.2e}) exceeds {tolerance} times the full one ({residuals[0]:.2e})."
+print("The sketched residuals are within the tolerance of the full one.")
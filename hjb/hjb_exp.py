@@ -104,6 +104,7 @@ for t in np.flipud(t_vec):
         vlist.append(vnext)
 
         count = 0
+        solver = None
         while count < maxPolIt:
             print(f"Norm: {np.linalg.norm(vlist[-1].components[vlist[-1].corePosition])}")
             # calculate rhs
@@ -119,12 +120,15 @@ for t in np.flipud(t_vec):
             if err < tol:
                 break
             # update v  alue function
-            solver = ALS(vlist[-1], augmented_train_measures,  rhs,
-                         _localL2Gramians=localL2Gramians, _localH1Gramians=localH1Gramians, _verbosity=1)
-            #solver = ALS(vlist[-1], augmented_train_measures,  rhs,
-            #             _verbosity=1)
-            solver.maxSweeps = maxSweeps
-            solver.targetResidual = 1e-5
+            if solver is None:
+                solver = ALS(vlist[-1], augmented_train_measures,  rhs,
+                             _localL2Gramians=localL2Gramians, _localH1Gramians=localH1Gramians, _verbosity=1)
+                #solver = ALS(vlist[-1], augmented_train_measures,  rhs,
+                #             _verbosity=1)
+                solver.maxSweeps = maxSweeps
+                solver.targetResidual = 1e-5
+            else:
+                solver.set_values(rhs)
             solver.run()
             count += 1
 
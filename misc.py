@@ -4,7 +4,7 @@ import numpy as np
 from numpy.polynomial.legendre import legval,legmul,legint,legder
 from numpy.polynomial.hermite_e import hermeval
 
-from bstt import Block, BlockSparseTT, BlockSparseTTSystem,BlockSparseTTSystem2
+from bstt import Block, BlockSparseTT, BlockSparseTTSystem,BlockSparseTTSystem2, ThreadPool
 from als import ALS
 
 
@@ -567,16 +567,23 @@ def random_full_system(_univariateDegrees, _interactionranges, _ranks, _selectio
 
 
 
-def recover_ml(_measures, _values, _degrees, _maxGroupSize, _maxIter=10, _maxSweeps=100, _targetResidual=1e-12, _verbosity=0):
+def recover_ml(_measures, _values, _degrees, _maxGroupSize, _maxIter=10, _maxSweeps=100, _targetResidual=1e-12, _verbosity=0,
+               _schedule='sequential', _damping=1, _numberOfThreads=1):
+    """
+    Fits one homogeneous polynomial BlockSparseTT per degree in `_degrees` such that their sum approximates `_values`.
+
+    With `_schedule == 'sequential'` the levels are refitted one after another against the values minus all other levels.
+    With `_schedule == 'jacobi'` all levels are refitted concurrently (on `_numberOfThreads` threads) against the same residual:
+    level k fits its current prediction plus `_damping` times the residual of the sum. The default damping 1 lets every level take
+    the whole residual, which makes the most progress per iteration when the levels are nearly orthogonal. If an iteration does not
+    decrease the residual (the levels overshoot), the levels are restored and the iteration falls back to the sequential schedule.
+    """
     if isinstance(_degrees, int):
         _degrees = list(range(_degrees+1))
     maxDegree = max(_degrees)
     order, numSamples, dimension = _measures.shape
     assert (numSamples,) == _values.shape and  dimension == maxDegree+1, f"NOT ({(numSamples,)} == {_values.shape} and {dimension} == {maxDegree+1})"
-
-    def residual(_bstts):
-        pred = sum(bstt.evaluate(_measures) for bstt in _bstts)
-        return np.linalg.norm(pred -  _values) / np.linalg.norm(_values)
+    assert _schedule in ['sequential', 'jacobi']
 
     bstts = [random_homogenous_polynomial_v2([maxDegree]*order, deg, _maxGroupSize) for deg in _degrees]
     for bstt in bstts:
@@ -585,16 +592,42 @@ def recover_ml(_measures, _values, _degrees, _maxGroupSize, _maxIter=10, _maxSwe
         bstt.components[0] *= 1e-3/np.linalg.norm(bstt.components[0])
     if _verbosity >= 1: print("="*80)
     res = np.inf
+    predictions = [bstt.evaluate(_measures) for bstt in bstts]  # only the predictions of the refitted levels change
+    # the solvers keep their stacks across iterations, only the values of each level change
+    solvers = [ALS(bstt, _measures, _values, _verbosity=_verbosity-1) for bstt in bstts]
+    for solver in solvers:
+        solver.maxSweeps = _maxSweeps
+        solver.targetResidual = _targetResidual
+
+    pool = ThreadPool(_numberOfThreads)  # the threads are reused in every iteration
+
+    def fit(_lvl, _lvl_values):
+        solvers[_lvl].set_values(_lvl_values)
+        solvers[_lvl].run()
+        return solvers[_lvl].predict()
+
+    def residual(_predictions):
+        return np.linalg.norm(sum(_predictions) - _values) / np.linalg.norm(_values)
+
     for itr in range(_maxIter):
         if _verbosity >= 1: print(f"Iteration: {itr}")
-        for lvl in range(len(bstts)):
-            lvl_values = _values - sum(bstt.evaluate(_measures) for bstt in bstts[:lvl]+bstts[lvl+1:])
-            solver = ALS(bstts[lvl], _measures, lvl_values, _verbosity=_verbosity-1)
-            solver.maxSweeps = _maxSweeps
-            solver.targetResidual = _targetResidual
-            solver.run()
-            bstts[lvl] = solver.bstt
-        old_res, res = res, residual(bstts)
+        sequential = _schedule == 'sequential'
+        if not sequential:
+            lvl_residual = _values - sum(predictions)
+            snapshots = [(solver.snapshot(), solver.prev_residual, solver.smin) for solver in solvers]
+            jacobi_predictions = pool.map(lambda lvl: fit(lvl, predictions[lvl] + _damping*lvl_residual), range(len(bstts)))
+            if residual(jacobi_predictions) < residual(predictions):
+                predictions = jacobi_predictions
+            else:
+                if _verbosity >= 1: print("Jacobi update stalled. Falling back to sequential updates.")
+                for solver, (snapshot, prev_residual, smin) in zip(solvers, snapshots):
+                    solver.restore(snapshot)
+                    solver.prev_residual, solver.smin = prev_residual, smin
+                sequential = True
+        if sequential:
+            for lvl in range(len(bstts)):
+                predictions[lvl] = fit(lvl, _values - sum(predictions[:lvl]+predictions[lvl+1:]))
+        old_res, res = res, residual(predictions)
         if _verbosity >= 1: print(f"Residual: {res:.2e}")
         if old_res < res or res < _targetResidual: break
         if _verbosity >= 1 and itr < _maxIter-1: print("-"*80)
@@ -0,0 +1,241 @@
+import numpy as np
+from bstt import Block, BlockSparseTT, ThreadPool
+
+
+class RiemannianGaussNewton(object):
+    """
+    Riemannian optimization of the least squares problem of ALS on the manifold of block sparse TTs with a fixed block structure.
+
+    Let U_k be the components of the left-orthogonal and V_k the components of the right-orthogonal representation of the current point
+    and C the last component of the left-orthogonal representation. Tangent vectors are represented by variations ξ_0,...,ξ_{order-1}
+    of the components, supported on the blocks and with U_k^T ξ_k = 0 for k < order-1. They represent the sum of the TTs
+    U_0 ... U_{k-1} ξ_k V_{k+1} ... V_{order-1}. The gradient with respect to all components is computed at once from the left stacks
+    (of U) and the right stacks (of V). All per-component contractions are independent and are dispatched onto numberOfThreads threads.
+
+    With method = 'gauss-newton' the damped Gauss-Newton system on the tangent space is solved by CG with a diagonal preconditioner
+    (at most maxCGIterations iterations up to a relative tolerance of cgTolerance). With method = 'gradient' the step is the Riemannian
+    gradient scaled by the minimizer of the linearized problem. In both cases the step is retracted by truncating the TT of doubled rank
+    with BlockSparseTT.round and halved until the residual decreases (retractions that lose a block are rejected as well).
+    After an accepted step the core of the bstt is at position order-1.
+    """
+    def __init__(self, _bstt, _measurements, _values, _verbosity=0):
+        assert isinstance(_bstt, BlockSparseTT)
+        self.bstt = _bstt
+        assert isinstance(_measurements, np.ndarray) and isinstance(_values, np.ndarray)
+        assert len(_measurements) == self.bstt.order
+        assert all(compMeas.shape == (len(_values), dim) for compMeas, dim in zip(_measurements, self.bstt.dimensions))
+        self.measurements = _measurements
+        self.values = _values
+        self.verbosity = _verbosity
+
+        self.maxIterations = 100
+        self.targetResidual = 1e-8
+        self.minDecrease = 1e-4
+        self.method = 'gauss-newton'
+        self.damping = 1e-6
+        self.maxCGIterations = 20
+        self.cgTolerance = 1e-2
+        self.maxHalvings = 10
+        self.numberOfThreads = 1
+        self.threadPool = None
+
+        self.linearize()
+
+    def map(self, _function):
+        if self.threadPool is None or self.threadPool.numberOfThreads != self.numberOfThreads:
+            self.threadPool = ThreadPool(self.numberOfThreads)
+        return self.threadPool.map(_function, range(self.bstt.order))
+
+    def linearize(self):
+        """
+        Computes the left- and right-orthogonal representations of the current point, their stacks and the masks of the blocks.
+        """
+        order = self.bstt.order
+        left = BlockSparseTT([np.array(comp) for comp in self.bstt.components], [list(blocks) for blocks in self.bstt.blocks])
+        left.assume_corePosition(0)
+        while left.corePosition < order-1:
+            left.move_core('right')
+        right = BlockSparseTT([np.array(comp) for comp in self.bstt.components], [list(blocks) for blocks in self.bstt.blocks])
+        right.assume_corePosition(order-1)
+        while right.corePosition > 0:
+            right.move_core('left')
+        self.U = left.components
+        self.V = right.components
+
+        N = len(self.values)
+        self.leftStack = [np.ones((N, 1))]
+        for pos in range(order-1):
+            self.leftStack.append(np.einsum('nl,ne,ler -> nr', self.leftStack[-1], self.measurements[pos], self.U[pos]))
+        self.rightStack = [np.ones((N, 1))]
+        for pos in reversed(range(1, order)):
+            self.rightStack.insert(0, np.einsum('ler,ne,nr -> nl', self.V[pos], self.measurements[pos], self.rightStack[0]))
+
+        def mask(pos):
+            ret = np.zeros(self.bstt.components[pos].shape)
+            for block in self.bstt.blocks[pos]:
+                ret[block] = 1
+            return ret
+        self.masks = self.map(mask)
+        self.prediction = np.einsum('nl,ne,ler -> n', self.leftStack[-1], self.measurements[-1], self.U[-1])
+
+    def residual(self):
+        return np.linalg.norm(self.prediction - self.values) / np.linalg.norm(self.values)
+
+    def project(self, _pos, _variation):
+        """
+        Projects the variation of the `_pos`-th component onto the blocks and the gauge condition.
+        """
+        ret = self.masks[_pos] * _variation
+        if _pos < self.bstt.order-1:
+            U = self.U[_pos].reshape(-1, self.U[_pos].shape[2])
+            ret -= (U @ (U.T @ ret.reshape(U.shape))).reshape(ret.shape)
+        return ret
+
+    def jacobian(self, _tangent):
+        terms = self.map(lambda pos: np.einsum('nl,ne,ler,nr -> n', self.leftStack[pos], self.measurements[pos], _tangent[pos], self.rightStack[pos]))
+        return np.sum(terms, axis=0)
+
+    def jacobian_transpose(self, _weights):
+        return self.map(lambda pos: self.project(pos, np.einsum('n,nl,ne,nr -> ler', _weights, self.leftStack[pos], self.measurements[pos], self.rightStack[pos])))
+
+    def preconditioner(self):
+        def diagonal(pos):
+            D = np.einsum('nl,ne,nr -> ler', self.leftStack[pos]**2, self.measurements[pos]**2, self.rightStack[pos]**2)
+            return np.where(self.masks[pos] > 0, D, 1)
+        return self.map(diagonal)
+
+    def gauss_newton_step(self, _gradient):
+        """
+        Solves (J^T J + λ I) ξ = J^T (y - f) on the tangent space by preconditioned CG where λ is damping times the mean diagonal of J^T J.
+        """
+        def inner(_x, _y):
+            return sum(np.vdot(x, y) for x, y in zip(_x, _y))
+        D = self.preconditioner()
+        damping = self.damping * np.mean([np.mean(d[m > 0]) for d, m in zip(D, self.masks)])
+        D = [d + damping for d in D]
+
+        def apply(_x):
+            JtJx = self.jacobian_transpose(self.jacobian(_x))
+            return [y + damping*x for x, y in zip(_x, JtJx)]
+
+        def precondition(_x):
+            return self.map(lambda pos: self.project(pos, _x[pos] / D[pos]))
+
+        x = [np.zeros_like(g) for g in _gradient]
+        r = list(_gradient)
+        z = precondition(r)
+        p = list(z)
+        rz = inner(r, z)
+        tolerance = self.cgTolerance * np.sqrt(inner(r, r))
+        for iteration in range(self.maxCGIterations):
+            Ap = apply(p)
+            alpha = rz / inner(p, Ap)
+            x = [xi + alpha*pi for xi, pi in zip(x, p)]
+            r = [ri - alpha*Api for ri, Api in zip(r, Ap)]
+            if np.sqrt(inner(r, r)) <= tolerance:
+                break
+            z = precondition(r)
+            rz, rz_old = inner(r, z), rz
+            p = [zi + (rz/rz_old)*pi for zi, pi in zip(z, p)]
+        if self.verbosity >= 2:
+            print(f"CG iterations: {iteration+1}")
+        return x
+
+    def retract(self, _tangent, _stepSize):
+        """
+        Truncates the TT of doubled rank that represents the current point plus `_stepSize` times `_tangent` to the block structure.
+        Returns None if the truncation loses a block (when the orthogonalization in BlockSparseTT.round is rank-deficient).
+        """
+        order = self.bstt.order
+
+        def doubled(slc):
+            return slice(2*slc.start, 2*slc.stop)
+        top, bottom = [], []
+        for pos in range(order-1):
+            slices = sorted({(block[2].start, block[2].stop) for block in self.bstt.blocks[pos]})
+            top.append(np.concatenate([np.arange(2*a, a+b) for a, b in slices]))
+            bottom.append(np.concatenate([np.arange(b+a, 2*b) for a, b in slices]))
+        components = []
+        for pos in range(order):
+            U, V, xi = self.U[pos], self.V[pos], _stepSize*_tangent[pos]
+            e = np.arange(U.shape[1])
+            if pos == 0:
+                comp = np.zeros((1, U.shape[1], 2*U.shape[2]))
+                comp[:, :, top[pos]] = xi
+                comp[:, :, bottom[pos]] = U
+            elif pos == order-1:
+                comp = np.zeros((2*U.shape[0], U.shape[1], 1))
+                comp[top[pos-1]] = V
+                comp[bottom[pos-1]] = U + xi
+            else:
+                comp = np.zeros((2*U.shape[0], U.shape[1], 2*U.shape[2]))
+                comp[np.ix_(top[pos-1], e, top[pos])] = V
+                comp[np.ix_(bottom[pos-1], e, top[pos])] = xi
+                comp[np.ix_(bottom[pos-1], e, bottom[pos])] = U
+            components.append(comp)
+        blocks = [[Block((block[0] if pos == 0 else doubled(block[0]), block[1], block[2] if pos == order-1 else doubled(block[2])))
+                   for block in self.bstt.blocks[pos]] for pos in range(order)]
+        ret = BlockSparseTT(components, blocks)
+        sizes = [[b-a for a, b in sorted({(block[2].start, block[2].stop) for block in self.bstt.blocks[pos]})] for pos in range(order-1)]
+        ret.round(sizes)
+        if ret.blocks != self.bstt.blocks:
+            return None
+        return ret
+
+    def step(self):
+        residual = self.values - self.prediction
+        gradient = self.jacobian_transpose(residual)
+        if self.method == 'gauss-newton':
+            tangent = self.gauss_newton_step(gradient)
+            stepSize = 1
+        else:
+            assert self.method == 'gradient'
+            tangent = gradient
+            Jg = self.jacobian(gradient)
+            stepSize = np.vdot(Jg, residual) / max(np.vdot(Jg, Jg), np.finfo(float).tiny)
+
+        prev_residual = self.residual()
+        components, corePosition = self.bstt.components, self.bstt.corePosition
+        for halving in range(self.maxHalvings):
+            candidate = self.retract(tangent, stepSize)
+            if candidate is not None:
+                self.bstt.components = candidate.components
+                self.bstt.assume_corePosition(self.bstt.order-1)
+                self.linearize()
+                if self.residual() < prev_residual:
+                    break
+            stepSize /= 2
+        else:
+            self.bstt.components = components
+            self.bstt.assume_corePosition(corePosition)
+            self.linearize()
+        if self.verbosity >= 2:
+            print(f"Step size: {stepSize:.2e}")
+
+    def run(self):
+        prev_residual = self.residual()
+        if self.verbosity >= 1:
+            print(f"Initial residuum: {prev_residual:.2e}")
+        for iteration in range(self.maxIterations):
+            self.step()
+            residual = self.residual()
+            if self.verbosity >= 1:
+                print(f"[{iteration}] Residuum: {residual:.2e}")
+
+            if residual < self.targetResidual:
+                if self.verbosity >= 1:
+                    print(f"Terminating (targetResidual reached)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+
+            if (prev_residual - residual) < self.minDecrease*residual:
+                if self.verbosity >= 1:
+                    print(f"Terminating (minDecrease reached)")
+                    print(f"Final residuum: {self.residual():.2e}")
+                return
+
+            prev_residual = residual
+
+        if self.verbosity >= 1:
+            print(f"Terminating (maxIterations reached)")
+            print(f"Final residuum: {self.residual():.2e}")
@@ -0,0 +1,115 @@
+import numpy as np
+from bstt import Block, BlockSparseTT
+
+
+def minibatches(_measurements, _values, _batchSize):
+    """
+    Yields (measurements, values) pairs of `_batchSize` random samples. Every epoch visits all samples in a new random order.
+    The last batch of an epoch holds the remaining samples and may be smaller. `_batchSize` is clamped to the number of samples.
+    """
+    N = len(_values)
+    assert N > 0 and _batchSize > 0
+    _batchSize = min(_batchSize, N)
+    while True:
+        permutation = np.random.permutation(N)
+        for start in range(0, N, _batchSize):
+            idcs = permutation[start:start+_batchSize]
+            yield _measurements[:, idcs], _values[idcs]
+
+
+class MiniBatchTrainer(object):
+    """
+    Stochastic training of a BlockSparseTT with fixed block structure from an iterator of (measurements, values) mini-batches
+    (e.g. `minibatches`). Only the data in the blocks of the components is updated, so the block structure is retained exactly.
+
+    Every step computes the gradient of the mean squared error of the batch with respect to all components from the left and right stacks
+    of the batch and updates the components by Adam (method = 'adam') or plain SGD (method = 'sgd') with the step size learningRate.
+    Every orthogonalizationPeriod steps the bstt is right-orthogonalized by move_core. Since this changes the gauge of the components,
+    the moment estimates of Adam are reset.
+    The result is an approximation that is meant to be refined by a few sweeps of ALS.
+    """
+    def __init__(self, _bstt, _batches, _verbosity=0):
+        assert isinstance(_bstt, BlockSparseTT)
+        self.bstt = _bstt
+        self.batches = iter(_batches)
+        self.verbosity = _verbosity
+
+        self.maxSteps = 1000
+        self.method = 'adam'
+        self.learningRate = 1e-3
+        self.beta1 = 0.9
+        self.beta2 = 0.999
+        self.epsilon = 1e-8
+        self.orthogonalizationPeriod = 100
+
+        self.orthogonalize()
+
+    def orthogonalize(self):
+        self.bstt.assume_corePosition(self.bstt.order-1)
+        while self.bstt.corePosition > 0:
+            self.bstt.move_core('left')
+        dofs = [sum(Block(block).size for block in blocks) for blocks in self.bstt.blocks]
+        self.firstMoments = [np.zeros(size) for size in dofs]
+        self.secondMoments = [np.zeros(size) for size in dofs]
+        self.adamStep = 0
+
+    def gradient(self, _measurements, _values):
+        """
+        Returns the block data of the gradient of the mean squared error of the batch and the relative residual of the batch.
+        """
+        order = self.bstt.order
+        n = len(_values)
+        leftStack = [np.ones((n, 1))]
+        for pos in range(order-1):
+            leftStack.append(np.einsum('nl,ne,ler -> nr', leftStack[-1], _measurements[pos], self.bstt.components[pos]))
+        rightStack = [np.ones((n, 1))]
+        for pos in reversed(range(1, order)):
+            rightStack.insert(0, np.einsum('ler,ne,nr -> nl', self.bstt.components[pos], _measurements[pos], rightStack[0]))
+        res = np.einsum('nl,ne,ler -> n', leftStack[-1], _measurements[-1], self.bstt.components[-1]) - _values
+
+        gradient = []
+        for pos in range(order):
+            G = np.einsum('n,nl,ne,nr -> ler', res, leftStack[pos], _measurements[pos], rightStack[pos]) / n
+            gradient.append(np.concatenate([G[block].reshape(-1) for block in self.bstt.blocks[pos]]))
+        return gradient, np.linalg.norm(res) / np.linalg.norm(_values)
+
+    def step(self):
+        measurements, values = next(self.batches)
+        assert len(measurements) == self.bstt.order
+        assert all(compMeas.shape == (len(values), dim) for compMeas, dim in zip(measurements, self.bstt.dimensions))
+        gradient, residual = self.gradient(measurements, values)
+        self.adamStep += 1
+        for pos, grad in enumerate(gradient):
+            if self.method == 'adam':
+                self.firstMoments[pos] = self.beta1*self.firstMoments[pos] + (1-self.beta1)*grad
+                self.secondMoments[pos] = self.beta2*self.secondMoments[pos] + (1-self.beta2)*grad**2
+                m = self.firstMoments[pos] / (1-self.beta1**self.adamStep)
+                v = self.secondMoments[pos] / (1-self.beta2**self.adamStep)
+                update = m / (np.sqrt(v) + self.epsilon)
+            else:
+                assert self.method == 'sgd'
+                update = grad
+            offset = 0
+            for block in map(Block, self.bstt.blocks[pos]):
+                self.bstt.components[pos][block] -= self.learningRate * update[offset:offset+block.size].reshape(block.shape)
+                offset += block.size
+        return residual
+
+    def run(self):
+        residuals = []
+        for step in range(self.maxSteps):
+            try:
+                residuals.append(self.step())
+            except StopIteration:
+                self.orthogonalize()
+                if self.verbosity >= 1:
+                    print(f"Terminating (no more batches)")
+                return
+            if (step+1) % self.orthogonalizationPeriod == 0:
+                self.orthogonalize()
+                if self.verbosity >= 1:
+                    print(f"[{step}] Mean batch residuum: {np.mean(residuals):.2e}")
+                residuals = []
+        self.orthogonalize()
+        if self.verbosity >= 1:
+            print(f"Terminating (maxSteps reached)")